@@ -0,0 +1,188 @@
+#!/usr/bin/python
+import gc
+import logging
+import optparse
+import os
+import random
+import sys
+import time
+
+USAGE = """%prog SDK_PATH [options]
+Offline benchmark of the API methods on the App Engine testbed stubs. The
+catalog, firehose, directions sheet, WordPress and calendar calls are answered
+from the fixtures with injected latency instead of going out to the network,
+and the directory is imported from its fixture file. The stubs answer one call
+at a time, so calls made in parallel in production add up here.
+
+SDK_PATH    Path to the SDK installation"""
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# URL fragment: fixture it is answered with, the first match wins
+ROUTES = [
+  ('/firehose', 'firehose_book.xml'),
+  ('catalog.json', 'catalog_search.json'),
+  ('/catalog/', 'catalog_item.json'),
+  ('spreadsheets.google.com', 'sheet_directions.json'),
+  ('get_recent_posts', 'libraries.json'),
+  ('googleapis.com/calendar', 'calendar_events.json'),
+]
+
+
+def fixture_urlfetch_stub(urlfetch_stub, latency, jitter, seed=11):
+  """ urlfetch stub answering from the fixtures, sleeping latency +/- jitter seconds per call """
+  rand = random.Random(seed)
+  fixtures = dict( (name, open(os.path.join(FIXTURES, name)).read()) for fragment, name in ROUTES )
+
+  class FixtureURLFetchServiceStub(urlfetch_stub.URLFetchServiceStub):
+    def _Dynamic_Fetch(self, request, response):
+      url = request.url()
+      for fragment, name in ROUTES:
+        if fragment in url:
+          break
+      else:
+        raise AssertionError('No fixture for ' + url)
+      time.sleep(max(0.0, latency + rand.uniform(-jitter, jitter)))
+      response.set_statuscode(200)
+      response.set_content(fixtures[name])
+      response.set_finalurl(url)
+
+  return FixtureURLFetchServiceStub()
+
+
+def percentile(samples, fraction):
+  return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(name, call, calls, reset=None):
+  """ Times calls runs of call(), after reset() each time when given """
+  call()
+  samples = []
+  gc.collect()
+  objects = len(gc.get_objects())
+  allocated = 0
+  for i in xrange(calls):
+    if reset is not None:
+      reset()
+    gc.disable()
+    before = gc.get_count()[0]
+    started = time.time()
+    call()
+    samples.append(time.time() - started)
+    # tracked objects allocated and not yet freed by the end of the call
+    allocated += gc.get_count()[0] - before
+    gc.enable()
+  gc.collect()
+  retained = len(gc.get_objects()) - objects
+  samples.sort()
+  print '%-34s %7.1f/s  p50 %7.2f  p95 %7.2f  p99 %7.2f  max %7.2f ms  %6d objs/call  %+6d retained' % (
+      name, calls / sum(samples), percentile(samples, 0.5) * 1000, percentile(samples, 0.95) * 1000,
+      percentile(samples, 0.99) * 1000, samples[-1] * 1000, allocated // calls, retained)
+
+
+def first_calls(name, call, calls, new_instance, warm_up):
+  """ Times the first call on a new instance, without and then with the warmup request run on the instance first """
+  timings = []
+  for warm in [None, warm_up]:
+    samples = []
+    for i in xrange(calls):
+      new_instance()
+      if warm is not None:
+        warm()
+      started = time.time()
+      call()
+      samples.append(time.time() - started)
+    samples.sort()
+    timings.extend([percentile(samples, 0.5) * 1000, percentile(samples, 0.95) * 1000])
+  print '%-34s p50 %7.2f  p95 %7.2f ms, after warmup p50 %7.2f  p95 %7.2f ms' % ((name,) + tuple(timings))
+
+
+def main(sdk_path, calls, latency, jitter, verbose):
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  from google.appengine.api import memcache
+  from google.appengine.api import urlfetch_stub
+  from google.appengine.ext import testbed
+  from protorpc import protojson
+
+  tb = testbed.Testbed()
+  tb.setup_env(current_version_id='testbed.version')
+  tb.activate()
+  tb.init_memcache_stub()
+  tb.init_datastore_v3_stub()
+  tb.init_taskqueue_stub()
+  stub = fixture_urlfetch_stub(urlfetch_stub, latency / 1000.0, jitter / 1000.0)
+  tb._register_stub(testbed.URLFETCH_SERVICE_NAME, stub)
+  logging.getLogger().setLevel(verbose and logging.INFO or logging.WARNING)
+
+  import uvalibrary_api
+  catalog = uvalibrary_api.CatalogApi()
+  libraries = uvalibrary_api.LibraryApi()
+  directions = uvalibrary_api.Directions()
+  search_request = uvalibrary_api.CatalogApi.SEARCH_RESOURCE.combined_message_class
+  item_request = uvalibrary_api.CatalogApi.ID_RESOURCE.combined_message_class
+  libraries_request = uvalibrary_api.LibraryApi.LIST_RESOURCE.combined_message_class
+  etag_request = uvalibrary_api.Directions.ETAG_RESOURCE.combined_message_class
+  hours = uvalibrary_api.HoursAPI()
+  hours_request = uvalibrary_api.HoursAPI.HOURS_RESOURCE.combined_message_class
+  directory = uvalibrary_api.DirectoryAPI()
+  directory_request = uvalibrary_api.DirectoryAPI.LIST_RESOURCE.combined_message_class
+  suggest_request = uvalibrary_api.DirectoryAPI.SUGGEST_RESOURCE.combined_message_class
+  uvalibrary_api.directorySource = os.path.join(FIXTURES, 'directory.json')
+
+  def served(method, request):
+    # Endpoints encodes the response as JSON on the way out
+    return lambda: protojson.encode_message(method(request))
+
+  def cold():
+    """ Empties memcache and this instance's caches, Datastore snapshots are kept like they are in production """
+    memcache.flush_all()
+    new_instance()
+
+  def new_instance():
+    """ Empties this instance's caches, as on an instance that just started """
+    uvalibrary_api.searchCache.entries.clear()
+    uvalibrary_api.holdingsCache.entries.clear()
+    uvalibrary_api.snapshotIndexes.clear()
+    uvalibrary_api.directionStore.snapshot = None
+
+  scenarios = [
+    ('search everything', served(catalog.search, search_request(**uvalibrary_api.warmupSearches[0]))),
+    ('search', served(catalog.search, search_request(query='python'))),
+    ('search availability', served(catalog.search, search_request(query='python', availability=True))),
+    ('search availability+directions', served(catalog.search, search_request(query='python', availability=True, directions=True))),
+    ('get_item', served(catalog.get_item, item_request(id='u4000000'))),
+    ('get_item availability+directions', served(catalog.get_item, item_request(id='u4000000', availability=True, directions=True))),
+    ('libraries.list', served(libraries.list, libraries_request())),
+    ('libraries.list labs, id and title', served(libraries.list, libraries_request(type=uvalibrary_api.LibraryType.lab, fields='id,title'))),
+    ('libraries.get', served(libraries.get, uvalibrary_api.LibraryApi.ID_RESOURCE.combined_message_class(id='alderman'))),
+    ('directions.list', served(directions.list, etag_request())),
+    ('hours.list week', served(hours.list, hours_request(days=7))),
+    ('hours.list open now', served(hours.list, hours_request(open_now=True))),
+    ('directory.list', served(directory.list, directory_request())),
+    ('directory.list page 2 of librarians', served(directory.list, directory_request(query='librarian', page=2))),
+    ('directory.suggest', served(directory.suggest, suggest_request(query='sm'))),
+  ]
+  print 'injected latency %d ms +/- %d ms per upstream call, %d calls each' % (latency, jitter, calls)
+  for state, reset in [('cold', cold), ('warm', None)]:
+    for name, call in scenarios:
+      run('%s %s' % (state, name), call, calls, reset)
+  print 'first call on a new instance, memcache and Datastore already filled by the calls above'
+  for name, call in scenarios:
+    first_calls(name, call, calls, new_instance, uvalibrary_api.Warmup().get)
+  tb.deactivate()
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(USAGE)
+  parser.add_option('--calls', type='int', default=50, help='timed calls per scenario')
+  parser.add_option('--latency', type='int', default=20, help='milliseconds each upstream call takes')
+  parser.add_option('--jitter', type='int', default=5, help='milliseconds the latency varies by')
+  parser.add_option('--verbose', action='store_true', default=False, help='keep the request logging')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    print 'Error: Exactly 1 argument required.'
+    parser.print_help()
+    sys.exit(1)
+  main(args[0], options.calls, options.latency, options.jitter, options.verbose)
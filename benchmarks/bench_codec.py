@@ -0,0 +1,63 @@
+#!/usr/bin/python
+import json
+import optparse
+import os
+import sys
+import timeit
+
+USAGE = """%prog SDK_PATH [options]
+Benchmark of the cache codec against protojson: the size of each cached value
+and how long it takes to encode and decode.
+
+SDK_PATH    Path to the SDK installation"""
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def main(sdk_path, items, repeat):
+  sys.path.insert(0, sdk_path)
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  import uvalibrary_api
+  from bench_json import scaled_response
+  from protorpc import protojson
+
+  def fixture(name):
+    return json.load(open(os.path.join(FIXTURES, name)))
+
+  catalog = uvalibrary_api.CatalogApi()
+  collection = catalog.load_results(json.loads(scaled_response(items)))
+  values = [
+    ('item', collection.items[0]),
+    ('holdings', catalog.load_holdings(open(os.path.join(FIXTURES, 'firehose_book.xml')).read())),
+    ('search, %d items' % items, collection),
+    ('libraries', uvalibrary_api.LibraryApi().load_libraries(fixture('libraries.json'))),
+    ('directions', uvalibrary_api.load_directions(fixture('sheet_directions.json'))),
+  ]
+  print '%-20s %9s %9s %6s  %9s %9s  %9s %9s  (ms, best of %d)' % (
+      '', 'protojson', 'codec', 'ratio', 'encode', 'codec', 'decode', 'codec', repeat)
+  for name, message in values:
+    text = protojson.encode_message(message)
+    binary = uvalibrary_api.encode_cached(message)
+    assert uvalibrary_api.decode_cached(type(message), binary) == message, name
+    timings = [min(timeit.repeat(stage, number=1, repeat=repeat)) * 1000 for stage in [
+      lambda: protojson.encode_message(message),
+      lambda: uvalibrary_api.encode_cached(message),
+      lambda: protojson.decode_message(type(message), text),
+      lambda: uvalibrary_api.decode_cached(type(message), binary),
+    ]]
+    print '%-20s %9d %9d %5.1fx  %9.3f %9.3f  %9.3f %9.3f' % (
+        (name, len(text), len(binary), float(len(text)) / len(binary)) + tuple(timings))
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(USAGE)
+  parser.add_option('--items', type='int', default=100, help='items in the search result')
+  parser.add_option('--repeat', type='int', default=20, help='runs to take the best of')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    print 'Error: Exactly 1 argument required.'
+    parser.print_help()
+    sys.exit(1)
+  main(args[0], options.items, options.repeat)
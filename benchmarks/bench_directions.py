@@ -0,0 +1,85 @@
+#!/usr/bin/python
+import optparse
+import random
+import sys
+import timeit
+
+USAGE = """%prog SDK_PATH [options]
+Micro-benchmark of the compiled directions matcher against the linear scan.
+
+SDK_PATH    Path to the SDK installation"""
+
+
+def make_sheet(uvalibrary_api, rows):
+  """ Synthetic directions sheet shaped like the Alderman spreadsheet """
+  rand = random.Random(42)
+  directions = uvalibrary_api.DirectionCollection()
+  for i in xrange(rows):
+    direction = uvalibrary_api.Direction(library=rand.choice(['alderman', 'alderman', 'clemons']),
+                                         title='Row %d' % i)
+    kind = rand.randint(0, 2)
+    if kind == 0:
+      direction.location_key = 'LOC%03d' % rand.randint(0, rows)
+    elif kind == 1:
+      direction.format_key = rand.choice(['Book', 'Journal/Magazine', 'Video', 'Sound Recording'])
+      direction.call_key = rand.choice(['QA', 'PR', 'PS', 'Z', 'REF'])
+    else:
+      start = rand.randint(0, 9000)
+      direction.start_call_number = '%s %04d' % (rand.choice('ABDHPQ'), start)
+      direction.end_call_number = '%s %04d' % (rand.choice('HPQZ'), start + rand.randint(0, 900))
+    directions.directions.append(direction)
+  return directions
+
+
+def make_queries(count):
+  rand = random.Random(7)
+  queries = []
+  for i in xrange(count):
+    queries.append(( rand.choice(['alderman', 'clemons', 'ivy']),
+                     '%s %04d .%s' % (rand.choice('ABDHPQZ'), rand.randint(0, 9999), rand.choice(['QA', 'PR', 'X'])),
+                     rand.choice(['Book', 'Video', 'Microfilm']),
+                     rand.choice(['Stacks', 'LOC%03d Reference' % rand.randint(0, 500), 'Reserve']) ))
+  return queries
+
+
+def main(sdk_path, rows, queries, repeat):
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  import uvalibrary_api
+
+  directions = make_sheet(uvalibrary_api, rows)
+  lookups = make_queries(queries)
+
+  start = timeit.default_timer()
+  matcher = uvalibrary_api.DirectionMatcher(directions)
+  compile_time = timeit.default_timer() - start
+
+  for lookup in lookups:
+    assert matcher.match(*lookup) is uvalibrary_api.scan_directions(directions, *lookup), lookup
+
+  linear = min(timeit.repeat(
+      lambda: [uvalibrary_api.scan_directions(directions, *lookup) for lookup in lookups],
+      number=1, repeat=repeat))
+  compiled = min(timeit.repeat(
+      lambda: [matcher.match(*lookup) for lookup in lookups],
+      number=1, repeat=repeat))
+
+  print '%d rows, %d lookups (best of %d)' % (rows, queries, repeat)
+  print 'compile:  %8.2f ms' % (compile_time * 1000)
+  print 'linear:   %8.2f ms  (%.1f us/lookup)' % (linear * 1000, linear * 1e6 / queries)
+  print 'compiled: %8.2f ms  (%.1f us/lookup)' % (compiled * 1000, compiled * 1e6 / queries)
+  print 'speedup:  %8.1fx' % (linear / compiled)
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(USAGE)
+  parser.add_option('--rows', type='int', default=300, help='rows in the directions sheet')
+  parser.add_option('--queries', type='int', default=2000, help='lookups per run')
+  parser.add_option('--repeat', type='int', default=5, help='runs to take the best of')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    print 'Error: Exactly 1 argument required.'
+    parser.print_help()
+    sys.exit(1)
+  main(args[0], options.rows, options.queries, options.repeat)
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+import copy
+import json
+import optparse
+import os
+import sys
+import timeit
+
+USAGE = """%prog SDK_PATH [options]
+Benchmark of the directory index: how long it takes to build, and how long
+type-ahead and paged lookups take on it as a query is typed.
+
+SDK_PATH    Path to the SDK installation"""
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# what a user types, one keystroke at a time
+TYPED = ['smith', 'research lib', "o'b", 'digital strategies eng', 'zz']
+
+
+def scaled_directory(entries):
+  """ The fixture directory with its people repeated up to the given number of entries """
+  people = json.load(open(os.path.join(FIXTURES, 'directory.json')))['people']
+  scaled = []
+  for i in xrange(entries):
+    person = copy.deepcopy(people[i % len(people)])
+    person['id'] = '%s%d' % (person['id'], i)
+    scaled.append(person)
+  return {'people': scaled}
+
+
+def main(sdk_path, entries, repeat):
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  import uvalibrary_api
+
+  collection = uvalibrary_api.load_directory(scaled_directory(entries))
+  build = min(timeit.repeat(lambda: uvalibrary_api.DirectoryIndex(collection, 'v'), number=1, repeat=3))
+  index = uvalibrary_api.DirectoryIndex(collection, 'v')
+  print '%d entries, %d name tokens, %d tokens, index built in %.1f ms' % (
+      entries, len(index.names.tokens), len(index.everything.tokens), build * 1000)
+  print '%-28s %7s %12s %12s  (ms, best of %d)' % ('', 'matches', 'suggest', 'page 1', repeat)
+  for typed in TYPED:
+    for length in xrange(1, len(typed) + 1):
+      query = typed[:length]
+      suggest = min(timeit.repeat(lambda: index.suggest(query, uvalibrary_api.directorySuggestLimit), number=1, repeat=repeat))
+      page = min(timeit.repeat(lambda: index.page(query, 1, 20), number=1, repeat=repeat))
+      print '%-28r %7d %12.4f %12.4f' % (query, index.page(query, 1, 20).count, suggest * 1000, page * 1000)
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(USAGE)
+  parser.add_option('--entries', type='int', default=5000, help='people in the directory')
+  parser.add_option('--repeat', type='int', default=50, help='runs to take the best of')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    print 'Error: Exactly 1 argument required.'
+    parser.print_help()
+    sys.exit(1)
+  main(args[0], options.entries, options.repeat)
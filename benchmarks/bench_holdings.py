@@ -0,0 +1,104 @@
+#!/usr/bin/python
+import glob
+import optparse
+import os
+import re
+import sys
+import timeit
+import xml.etree.ElementTree as ElementTree
+
+USAGE = """%prog SDK_PATH [options]
+Benchmark of the firehose holdings parser over the recorded fixtures.
+
+SDK_PATH    Path to the SDK installation"""
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def tree_load_holdings(uvalibrary_api, content):
+  """ The whole-document parser load_holdings replaced, with its per-copy lookups """
+  availability = uvalibrary_api.ItemAvailability()
+  root = ElementTree.fromstring(content)
+  can_hold = root.find('canHold')
+  if can_hold:
+    availability.can_hold = can_hold.attrib.get('value',"yes") != "no"
+    availability.can_hold_message = can_hold.find('message').text
+  for holding_info in root.findall('holding'):
+    holding = uvalibrary_api.Holding()
+    holding.call_number = holding_info.attrib.get('callNumber','')
+    holding.call_number_normalized = holding_info.find('shelvingKey').text
+    holding.call_sequence = holding_info.attrib.get('callSequence','')
+    holding.can_hold = holding_info.attrib.get('holdable','true') != "false"
+    holding.shadowed = holding_info.attrib.get('shadowed','true') != "false"
+    holding.copies = []
+    for copy_info in holding_info.findall('copy'):
+      copy = uvalibrary_api.Copy()
+      copy.copy_number = copy_info.attrib.get('copyNumber','')
+      copy.current_periodical = copy_info.attrib.get('currentPeriodical','true') != "false"
+      copy.barcode = copy_info.attrib.get('barcode','')
+      copy.shadowed = copy_info.attrib.get('shadowed','true') != "false"
+      copy.circulate = copy_info.find('circulate') == "Y"
+      current_loc = copy_info.find('currentLocation')
+      library_info = holding_info.find('library')
+      holding.library = library_info.find('name').text
+      holding.library_code = library_info.attrib.get('code','')
+      copy.current_location = current_loc.find('name').text
+      copy.current_location_code = current_loc.attrib.get('code','')
+      home_loc = copy_info.find('homeLocation')
+      copy.home_location = home_loc.find('name').text
+      copy.home_location_code = home_loc.attrib.get('code','')
+      copy.item_type_code = copy_info.find('itemType').attrib.get('code','')
+      copy.last_checkout = copy_info.find('lastCheckout').text
+      holding.copies.append(copy)
+    holding.deliverable = library_info.find('deliverable').text != "false"
+    holding.holdable = library_info.find('holdable').text != "false"
+    holding.remote = library_info.find('remote').text != "false"
+    availability.holdings.append(holding)
+  return availability
+
+
+def serial(content, holdings, copies):
+  """ Scales a recorded document up to a serial with many holdings of many copies """
+  holding = re.search(r'<holding .*?</holding>', content, re.S).group(0)
+  copy = re.search(r'<copy .*?</copy>', holding, re.S).group(0)
+  holding = holding.replace(copy, copy * copies)
+  body = ''.join(holding.replace('callSequence="1"', 'callSequence="%d"' % i) for i in xrange(holdings))
+  return re.sub(r'<holding .*</holding>', lambda m: body, content, flags=re.S)
+
+
+def main(sdk_path, holdings, copies, repeat):
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  import uvalibrary_api
+  from protorpc import protojson
+
+  catalog = uvalibrary_api.CatalogApi()
+  documents = []
+  for path in sorted(glob.glob(os.path.join(FIXTURES, 'firehose_*.xml'))):
+    content = open(path).read()
+    documents.append( (os.path.basename(path), content) )
+    documents.append( ('%s as %dx%d serial' % (os.path.basename(path), holdings, copies), serial(content, holdings, copies)) )
+
+  print 'parser: %s (best of %d)' % (uvalibrary_api.ET.__name__, repeat)
+  for name, content in documents:
+    tree = tree_load_holdings(uvalibrary_api, content)
+    streamed = catalog.load_holdings(content)
+    assert protojson.encode_message(tree) == protojson.encode_message(streamed), name
+    before = min(timeit.repeat(lambda: tree_load_holdings(uvalibrary_api, content), number=1, repeat=repeat))
+    after = min(timeit.repeat(lambda: catalog.load_holdings(content), number=1, repeat=repeat))
+    print '%-40s %7d bytes  tree %8.2f ms  iterparse %8.2f ms  %5.1fx' % (
+        name, len(content), before * 1000, after * 1000, before / after)
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(USAGE)
+  parser.add_option('--holdings', type='int', default=20, help='holdings in the scaled up serial')
+  parser.add_option('--copies', type='int', default=25, help='copies per holding in the scaled up serial')
+  parser.add_option('--repeat', type='int', default=5, help='runs to take the best of')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    print 'Error: Exactly 1 argument required.'
+    parser.print_help()
+    sys.exit(1)
+  main(args[0], options.holdings, options.copies, options.repeat)
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+import copy
+import json
+import optparse
+import os
+import sys
+import timeit
+
+USAGE = """%prog SDK_PATH [options]
+Benchmark of turning a catalog response into a cached search and item cache
+entries: protojson with every item encoded again, against the cache codec
+with the item cache values sliced from the search's encoding.
+
+SDK_PATH    Path to the SDK installation"""
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def scaled_response(items):
+  """ The recorded search response with its documents repeated up to the given number of items """
+  results = json.load(open(os.path.join(FIXTURES, 'catalog_search.json')))
+  docs = results['response']['docs']
+  scaled = []
+  for i in xrange(items):
+    doc = copy.deepcopy(docs[i % len(docs)])
+    doc['id'] = 'u%d' % (5000000 + i)
+    scaled.append(doc)
+  results['response']['docs'] = scaled
+  return json.dumps(results)
+
+
+def main(sdk_path, items, repeat):
+  sys.path.insert(0, sdk_path)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  import uvalibrary_api
+  from protorpc import protojson
+
+  catalog = uvalibrary_api.CatalogApi()
+  content = scaled_response(items)
+
+  def before_fetched():
+    # one encode for the search cache, then it was decoded and every item encoded again for the item cache
+    return before_cached(protojson.encode_message(catalog.load_results(json.loads(content))))
+
+  def before_cached(encoded):
+    collection = protojson.decode_message(uvalibrary_api.ItemCollection, encoded)
+    return collection, dict( (item.id, protojson.encode_message(item)) for item in collection.items )
+
+  def after_fetched():
+    # the collection that was built is used as is, the item cache values are sliced from its encoding
+    collection = catalog.load_results(json.loads(content))
+    return uvalibrary_api.decode_collection(uvalibrary_api.encode_collection(collection), collection)
+
+  def decoded_items(encoded, decode):
+    return dict( (id, decode(uvalibrary_api.Item, value)) for id, value in encoded.items() )
+
+  old, new = before_fetched(), after_fetched()
+  assert old[0] == new[0]
+  assert decoded_items(old[1], protojson.decode_message) == decoded_items(new[1], uvalibrary_api.decode_cached)
+  assert new == uvalibrary_api.decode_collection(uvalibrary_api.encode_collection(new[0]))
+  old_entry = protojson.encode_message(old[0])
+  new_entry = uvalibrary_api.encode_collection(new[0])
+  stages = [
+    ('json decode', lambda: json.loads(content)),
+    ('fetched, before', before_fetched),
+    ('fetched, after', after_fetched),
+    ('from memcache, before', lambda: before_cached(old_entry)),
+    ('from memcache, after', lambda: uvalibrary_api.decode_collection(new_entry)),
+  ]
+  print '%d items with all facets, %d bytes (best of %d)' % (items, len(content), repeat)
+  for name, stage in stages:
+    best = min(timeit.repeat(stage, number=1, repeat=repeat))
+    print '%-24s %8.2f ms' % (name, best * 1000)
+
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser(USAGE)
+  parser.add_option('--items', type='int', default=100, help='items in the search response')
+  parser.add_option('--repeat', type='int', default=20, help='runs to take the best of')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    print 'Error: Exactly 1 argument required.'
+    parser.print_help()
+    sys.exit(1)
+  main(args[0], options.items, options.repeat)
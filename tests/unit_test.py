@@ -1,6 +1,7 @@
-import unittest, webtest, endpoints
+import unittest, webtest, endpoints, random, datetime, time, pickle, hashlib
 import uvalibrary_api
 from google.appengine.api import memcache
+from google.appengine.api import urlfetch
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from google.appengine.datastore import datastore_stub_util
@@ -36,4 +37,405 @@ class TestCases(unittest.TestCase):
     msg = {}
     resp = testapp.post_json('/_ah/spi/Directions.list', msg)
     # Make sure we have some results
-    self.assertTrue( len(resp.json.get('directions',[])) > 0 )
\ No newline at end of file
+    self.assertTrue( len(resp.json.get('directions',[])) > 0 )
+
+  def testDirectionMatcher(self):
+    rand = random.Random(1)
+    directions = uvalibrary_api.DirectionCollection()
+    for i in range(200):
+      direction = uvalibrary_api.Direction(library=rand.choice(['alderman','Alderman','clemons']), title=str(i))
+      direction.location_key = rand.choice(['', 'ref', 'REF DESK', 'stacks'])
+      direction.format_key = rand.choice(['', 'book', 'Video'])
+      direction.call_key = rand.choice(['', 'qa', 'PR'])
+      direction.start_call_number = rand.choice(['', 'A %d' % i, 'QA %d' % i])
+      direction.end_call_number = rand.choice(['', 'M %d' % i, 'QA %d' % (i+5)])
+      directions.directions.append(direction)
+    matcher = uvalibrary_api.DirectionMatcher(directions)
+    for i in range(500):
+      lookup = ( rand.choice(['alderman','ALDERMAN','ivy']),
+                 rand.choice(['', 'QA %d' % rand.randint(0,220), 'B 12', 'PR 1']),
+                 rand.choice(['', 'Book', 'video']),
+                 rand.choice(['', 'Reference Desk', 'Stacks', 'ref']) )
+      # Same first match as the original linear scan
+      self.assertIs( matcher.match(*lookup), uvalibrary_api.scan_directions(directions, *lookup) )
+
+  def testLRUCache(self):
+    cache = uvalibrary_api.LRUCache('test', 2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    self.assertEqual( cache.get('a'), 1 )
+    # 'b' is now the least recently used entry
+    cache.set('c', 3)
+    self.assertIsNone( cache.get('b') )
+    self.assertEqual( cache.get('c'), 3 )
+    cache.set('d', 4, ttl=-1)
+    self.assertIsNone( cache.get('d') )
+    stats = cache.stats()
+    self.assertEqual( (stats.hits, stats.misses, stats.evictions, stats.expirations), (2, 2, 2, 1) )
+
+  def testMetrics(self):
+    metrics = uvalibrary_api.Metrics()
+    @metrics.request('test.request')
+    def handle():
+      with metrics.timer('stage'):
+        metrics.count('thing')
+      metrics.record('stage', 0.2)
+      return metrics.local.stages['stage']
+    self.assertTrue( handle() >= 0.2 )
+    latencies = dict( (stats.name, stats) for stats in metrics.latency_stats() )
+    self.assertEqual( latencies['stage'].count, 2 )
+    self.assertEqual( sum(latencies['stage'].buckets), 2 )
+    self.assertEqual( latencies['test.request'].count, 1 )
+    self.assertEqual( [(c.name, c.value) for c in metrics.counter_stats()], [('thing', 1)] )
+
+  def testCanonicalSearchURL(self):
+    catalog = uvalibrary_api.CatalogApi()
+    request = uvalibrary_api.CatalogApi.SEARCH_RESOURCE.combined_message_class
+    url = catalog.search_url(request(query='jefferson  papers', facets='{"Library": "Alderman", "format": ["Video", "Book"]}'))[0]
+    same = catalog.search_url(request(query=' jefferson papers', page=1, author='',
+                                      facets='{"format": ["Book", "Video", "Book"], "library": ["Alderman"]}'))[0]
+    self.assertEqual( url, same )
+    self.assertEqual( uvalibrary_api.search_key('search', url), uvalibrary_api.search_key('search', same) )
+    self.assertEqual( url.count('sort_key='), 1 )
+    # score and cover_image_url never reach the URL, so the fields are part of the key
+    title, more = [catalog.search_url(request(query='jefferson', fields=fields)) for fields in ('title', 'title,cover_image_url,score')]
+    self.assertEqual( title[0], more[0] )
+    self.assertNotEqual( uvalibrary_api.search_key('search', title[0], title[1]), uvalibrary_api.search_key('search', more[0], more[1]) )
+    self.assertNotEqual( url, catalog.search_url(request(query='jefferson papers', facets='{"format": "Book"}'))[0] )
+
+  def testCacheCodec(self):
+    item = uvalibrary_api.Item(id='u1', title=['A title'], score=1.5)
+    collection = uvalibrary_api.ItemCollection(count=2, items=[item, uvalibrary_api.Item(id='u2', title=['x' * 2000])])
+    entry = uvalibrary_api.encode_collection(collection)
+    self.assertEqual( entry[:2], uvalibrary_api.cacheCodecVersion + 'z' )
+    decoded, items = uvalibrary_api.decode_collection(entry)
+    self.assertEqual( decoded, collection )
+    self.assertEqual( uvalibrary_api.decode_cached(uvalibrary_api.Item, items['u1']), item )
+    # values from before the codec and from other versions of it
+    self.assertEqual( uvalibrary_api.decode_cached(uvalibrary_api.Item, '{"id": "u1", "title": ["A title"], "score": 1.5}'), item )
+    self.assertIsNone( uvalibrary_api.decode_cached(uvalibrary_api.Item, '0p') )
+    # the item cache values follow the entry even when the collection given was built for a newer one
+    one, two = uvalibrary_api.Item(id='u1', title=['One']), uvalibrary_api.Item(id='u2', title=['Two'])
+    entry = uvalibrary_api.encode_collection(uvalibrary_api.ItemCollection(items=[one, two]))
+    decoded, items = uvalibrary_api.decode_collection(entry, uvalibrary_api.ItemCollection(items=[two, one]))
+    self.assertEqual( [item.id for item in decoded.items], ['u1', 'u2'] )
+    self.assertEqual( uvalibrary_api.decode_cached(uvalibrary_api.Item, items['u1']).title, ['One'] )
+    # a memcache entry of another version is a miss, loaded again
+    memcache.set('codec_test', (time.time() + 60, '0p'))
+    loaded = uvalibrary_api.encode_cached(item)
+    @ndb.tasklet
+    def loader():
+      raise ndb.Return(loaded)
+    self.assertEqual( uvalibrary_api.swr_get('codec_test', loader, (), 60, 60), loaded )
+    self.assertEqual( memcache.get('codec_test')[1], loaded )
+
+  def testCacheChunks(self):
+    for size in (uvalibrary_api.cacheChunkSize, uvalibrary_api.cacheChunkSize + 1):
+      value = uvalibrary_api.cacheCodecVersion + 'p' + 'x' * (size - 2)
+      uvalibrary_api.swr_store_async('chunk_test', value, 60, 60).get_result()
+      self.assertEqual( uvalibrary_api.swr_read_async('chunk_test').get_result()[1], value )
+    # the longest value stored in one entry still fits once pickled with its soft expiry
+    entry = pickle.dumps((time.time(), 'x' * uvalibrary_api.cacheChunkSize), pickle.HIGHEST_PROTOCOL)
+    self.assertLessEqual( len(entry), memcache.MAX_VALUE_SIZE )
+
+  def testFetchLockReleased(self):
+    # another instance holds the fetch lock, then its loader fails and lets the lock go without an entry
+    memcache.add('lock_test_lock', 1)
+    @ndb.tasklet
+    def release():
+      yield ndb.sleep(0.1)
+      memcache.delete('lock_test_lock')
+    calls = []
+    loaded = uvalibrary_api.encode_cached(uvalibrary_api.Item(id='lock'))
+    @ndb.tasklet
+    def loader():
+      calls.append(1)
+      yield ndb.sleep(0.05)
+      raise ndb.Return(loaded)
+    started = time.time()
+    waiters = [uvalibrary_api.swr_get_async('lock_test', loader, (), 60, 60) for i in xrange(2)]
+    release().get_result()
+    # one waiter takes the lock over and loads, the other gets its entry, neither waits out fetchLockWait
+    self.assertEqual( [waiter.get_result() for waiter in waiters], [loaded, loaded] )
+    self.assertEqual( calls, [1] )
+    self.assertLess( time.time() - started, uvalibrary_api.fetchLockWait )
+
+  def testLibraryIndex(self):
+    collection = uvalibrary_api.LibraryCollection(libraries=[
+      uvalibrary_api.Library(id='alderman', title='Alderman', phone='1', type=uvalibrary_api.LibraryType.library),
+      uvalibrary_api.Library(id='scholars-lab', title="Scholars' Lab", phone='2', type=uvalibrary_api.LibraryType.lab)])
+    index = uvalibrary_api.LibraryIndex(collection, 'v1')
+    self.assertEqual( index.get('alderman').phone, '1' )
+    self.assertIsNone( index.get('nope') )
+    labs = index.view(uvalibrary_api.LibraryType.lab, set(['id']))
+    self.assertEqual( [(library.id, library.phone) for library in labs.libraries], [('scholars-lab', None)] )
+    self.assertIs( index.view(uvalibrary_api.LibraryType.lab, set(['id'])), labs )
+    self.assertEqual( len(index.view().libraries), 2 )
+    # an empty fields= value asks for every field, and an empty set of fields does not share the full listing's view
+    self.assertIsNone( uvalibrary_api.parse_fields(' , ', uvalibrary_api.libraryFields) )
+    index.view(None, set())
+    self.assertEqual( [library.phone for library in index.view(None, None).libraries], ['1', '2'] )
+
+  def testExpandEvents(self):
+    events = [
+      {'id': 'weekday', 'start': {'dateTime': '2015-01-05T08:00:00-05:00'}, 'end': {'dateTime': '2015-01-06T02:00:00-05:00'},
+       'recurrence': ['RRULE:FREQ=WEEKLY;BYDAY=MO,TU', 'EXDATE;TZID=America/New_York:20150113T080000']},
+      {'id': 'weekday_20150112', 'status': 'cancelled', 'recurringEventId': 'weekday', 'originalStartTime': {'dateTime': '2015-01-12T08:00:00-05:00'}},
+      {'id': 'closed', 'summary': 'Closed', 'start': {'date': '2015-01-19'}, 'end': {'date': '2015-01-20'}}]
+    days = uvalibrary_api.expand_events(events, uvalibrary_api.parse_date('2015-01-01'), uvalibrary_api.parse_date('2015-01-20'))
+    self.assertEqual( sorted(day.isoformat() for day in days), ['2015-01-05', '2015-01-06', '2015-01-19', '2015-01-20'] )
+    self.assertEqual( [(interval.opens, interval.closes) for interval in days[uvalibrary_api.parse_date('2015-01-05')].intervals], [(480, 1560)] )
+    self.assertEqual( days[uvalibrary_api.parse_date('2015-01-19')].label, 'Closed' )
+    table = uvalibrary_api.HoursTable(uvalibrary_api.HoursCollection(libraries=[
+      uvalibrary_api.LibraryHours(library='alderman', days=[days[day] for day in sorted(days)])]), 'v1')
+    self.assertTrue( table.open_at('alderman', datetime.datetime(2015, 1, 6, 1, 30)) )
+    self.assertFalse( table.open_at('alderman', datetime.datetime(2015, 1, 19, 9)) )
+    # all day events of several days cover each of them, also when they started before the first day
+    events = [
+      {'id': 'holidays', 'summary': 'Closed', 'start': {'date': '2014-12-24'}, 'end': {'date': '2014-12-29'}},
+      {'id': 'weekend', 'summary': 'Closed', 'start': {'date': '2014-12-27'}, 'end': {'date': '2014-12-29'}, 'recurrence': ['RRULE:FREQ=WEEKLY;BYDAY=SA']}]
+    days = uvalibrary_api.expand_events(events, uvalibrary_api.parse_date('2014-12-25'), uvalibrary_api.parse_date('2015-01-04'))
+    self.assertEqual( sorted(day.isoformat() for day in days), ['2014-12-25', '2014-12-26', '2014-12-27', '2014-12-28', '2015-01-03', '2015-01-04'] )
+    self.assertEqual( days[uvalibrary_api.parse_date('2014-12-27')].label, 'Closed, Closed' )
+    days = uvalibrary_api.expand_events(events, uvalibrary_api.parse_date('2014-12-28'), uvalibrary_api.parse_date('2014-12-31'))
+    self.assertEqual( sorted(day.isoformat() for day in days), ['2014-12-28'] )
+
+  def testBuildHours(self):
+    # without a calendarAPIKey there are no hours and the cron takes no snapshot of them
+    self.assertEqual( uvalibrary_api.current_hours().libraries, [] )
+    self.assertIsNone( uvalibrary_api.refresh_snapshot_async('hours').get_result() )
+    libraries = uvalibrary_api.LibraryIndex(uvalibrary_api.LibraryCollection(libraries=[
+      uvalibrary_api.Library(id='alderman', title='Alderman', hours_calendar_id='a'),
+      uvalibrary_api.Library(id='clemons', title='Clemons', hours_calendar_id='c')]), 'v1')
+    today = uvalibrary_api.local_time(datetime.datetime.utcnow()).date().isoformat()
+    event = {'id': 'open', 'start': {'dateTime': today+'T08:00:00-05:00'}, 'end': {'dateTime': today+'T17:00:00-05:00'}}
+    calendars = {}
+    @ndb.tasklet
+    def fetch_calendar(calendar_id, first_day, last_day):
+      raise ndb.Return(calendars.get(calendar_id))
+    saved = uvalibrary_api.calendarAPIKey, uvalibrary_api.current_libraries, uvalibrary_api.fetch_calendar
+    uvalibrary_api.calendarAPIKey, uvalibrary_api.current_libraries, uvalibrary_api.fetch_calendar = 'key', lambda: libraries, fetch_calendar
+    try:
+      # when no calendar loads the refresh fails instead of saving an empty table
+      self.assertRaises( urlfetch.Error, uvalibrary_api.refresh_snapshot_async('hours').get_result )
+      self.assertIsNone( uvalibrary_api.SnapshotHead.get_by_id('hours') )
+      calendars.update(a=[event], c=[event])
+      uvalibrary_api.refresh_snapshot_async('hours').get_result()
+      first = uvalibrary_api.SnapshotHead.get_by_id('hours').version
+      # a library whose calendar failed keeps its days from the last good snapshot
+      del calendars['c']
+      calendars['a'] = [dict(event, start={'dateTime': today+'T09:00:00-05:00'})]
+      value = uvalibrary_api.refresh_snapshot_async('hours').get_result()
+    finally:
+      uvalibrary_api.calendarAPIKey, uvalibrary_api.current_libraries, uvalibrary_api.fetch_calendar = saved
+    # the snapshot the head moved away from is deleted
+    self.assertIsNone( uvalibrary_api.Snapshot.get_by_id('hours@'+first) )
+    self.assertIsNotNone( uvalibrary_api.Snapshot.get_by_id('hours@'+uvalibrary_api.SnapshotHead.get_by_id('hours').version) )
+    hours = uvalibrary_api.decode_cached(uvalibrary_api.HoursCollection, value)
+    self.assertEqual( [(library.library, [day.date for day in library.days]) for library in hours.libraries],
+                      [('alderman', [today]), ('clemons', [today])] )
+
+  def testDirectoryIndex(self):
+    collection = uvalibrary_api.load_directory({'people': [
+      {'id': 'js1a', 'name': 'Jane Smith', 'title': 'Research Librarian', 'department': 'Research and Learning Services'},
+      {'id': 'ob2b', 'name': "Pat O'Brien", 'title': 'Archivist', 'department': 'Special Collections'},
+      {'id': 'aw3c', 'name': 'Alex Wu', 'title': 'Software Engineer', 'department': 'Smithsonian Projects'}]})
+    index = uvalibrary_api.DirectoryIndex(collection, 'v1')
+    self.assertEqual( [entry.id for entry in index.suggest('sm', 10).entries], ['js1a', 'aw3c'] )
+    self.assertEqual( [entry.id for entry in index.suggest('obri', 10).entries], ['ob2b'] )
+    self.assertEqual( [entry.id for entry in index.suggest('research lib', 10).entries], ['js1a'] )
+    self.assertEqual( index.suggest('nobody', 10).count, 0 )
+    page = index.page('', 2, 2)
+    self.assertEqual( (page.count, [entry.id for entry in page.entries]), (3, ['aw3c']) )
+
+  def testDirectoryUnconfigured(self):
+    # without a directorySource the directory is empty and the cron takes no snapshot of it
+    self.assertIsNone( uvalibrary_api.directorySource )
+    index = uvalibrary_api.current_directory()
+    self.assertEqual( (index.page('', 1, 10).count, index.suggest('sm', 10).count, index.by_id.get('js1a')), (0, 0, None) )
+    self.assertIsNone( uvalibrary_api.refresh_snapshot_async('directory').get_result() )
+    self.assertIsNone( uvalibrary_api.SnapshotHead.get_by_id('directory') )
+
+  def testAvailabilityPending(self):
+    calls = []
+    class Catalog(uvalibrary_api.CatalogApi):
+      @ndb.tasklet
+      def fetch_firehose_async(self, id, deadline):
+        calls.append(id)
+        # u2's firehose answers with an error page
+        raise ndb.Return(id == 'u2' and '<html><body>Service Unavailable' or '<catalogItem></catalogItem>')
+    uvalibrary_api.holdingsCache.entries.clear()
+    collection = uvalibrary_api.ItemCollection(items=[uvalibrary_api.Item(id='u1'), uvalibrary_api.Item(id='u2')])
+    Catalog().get_collection_availability(collection, False)
+    self.assertEqual( [item.availability_pending for item in collection.items], [False, True] )
+    self.assertIsNotNone( uvalibrary_api.holdingsCache.peek('u1') )
+    self.assertIsNone( uvalibrary_api.holdingsCache.peek('u2') )
+    self.assertIsNone( memcache.get('holdings_u2') )
+    # items still waiting when the budget runs out are pending, without a call
+    budget, uvalibrary_api.availabilityBudget = uvalibrary_api.availabilityBudget, 0
+    try:
+      collection = uvalibrary_api.ItemCollection(items=[uvalibrary_api.Item(id='u3')])
+      Catalog().get_collection_availability(collection, False)
+    finally:
+      uvalibrary_api.availabilityBudget = budget
+    self.assertTrue( collection.items[0].availability_pending )
+    self.assertEqual( calls, ['u1', 'u2'] )
+
+  def testGetItems(self):
+    fetched = []
+    class Catalog(uvalibrary_api.CatalogApi):
+      def fetch_items(self, ids):
+        fetched.append(ids)
+        return [uvalibrary_api.Item(id=id) for id in ids if id != 'gone']
+    memcache.set('items_u1', uvalibrary_api.encode_cached(uvalibrary_api.Item(id='u1', title=['Cached'])))
+    request = uvalibrary_api.CatalogApi.IDS_RESOURCE.combined_message_class
+    collection = Catalog().get_items(request(ids=['u2', 'u1', 'uva-lib:123', 'gone', 'u2']))
+    self.assertEqual( [item.id for item in collection.items], ['u2', 'u1', 'uva-lib:123', 'u2'] )
+    self.assertEqual( collection.items[1].title, ['Cached'] )
+    # the misses are fetched once each, in one call
+    self.assertEqual( fetched, [['u2', 'uva-lib:123', 'gone']] )
+    self.assertIsNotNone( memcache.get('items_uva-lib:123') )
+    with self.assertRaises(endpoints.BadRequestException):
+      Catalog().get_items(request(ids=['u%d' % i for i in xrange(uvalibrary_api.maxItemIds + 1)]))
+
+  def testGetItemNotFound(self):
+    class Catalog(uvalibrary_api.CatalogApi):
+      def fetch_item(self, id):
+        if id == 'broken':
+          raise ValueError('Not JSON')
+        return None
+    request = uvalibrary_api.CatalogApi.ID_RESOURCE.combined_message_class
+    with self.assertRaises(endpoints.NotFoundException):
+      Catalog().get_item(request(id='u404'))
+    with self.assertRaises(endpoints.InternalServerErrorException):
+      Catalog().get_item(request(id='broken'))
+    # ids are a single path segment of the catalog URL, and may be any unicode
+    urls = []
+    fetch = uvalibrary_api.urlfetch.fetch
+    uvalibrary_api.urlfetch.fetch = lambda url, deadline: urls.append(url) or type('Result', (), {'status_code': 404})()
+    try:
+      with self.assertRaises(endpoints.NotFoundException):
+        uvalibrary_api.CatalogApi().get_item(request(id=u'uva-lib/caf\xe9'))
+    finally:
+      uvalibrary_api.urlfetch.fetch = fetch
+    self.assertEqual( urls, [uvalibrary_api.catalogItemURL % 'uva-lib%2Fcaf%C3%A9'] )
+
+  def testItemCacheWriter(self):
+    writer = uvalibrary_api.ItemCacheWriter(2, 60)
+    writer.add({'u7': 'seven'})
+    self.assertEqual( writer.get('u7'), 'seven' )
+    with writer.flushing():
+      pass
+    self.assertIsNone( memcache.get('items_u7') )
+    # due once the oldest item has waited max_delay, from any request that flushes
+    writer.oldest -= 61
+    with writer.flushing():
+      pass
+    self.assertEqual( memcache.get('items_u7'), 'seven' )
+    self.assertIsNone( writer.get('u7') )
+
+  def testPageToken(self):
+    catalog = uvalibrary_api.CatalogApi()
+    request_class = uvalibrary_api.CatalogApi.SEARCH_RESOURCE.combined_message_class
+    prefetches = []
+    defer = uvalibrary_api.deferred.defer
+    uvalibrary_api.deferred.defer = lambda *args, **kwargs: prefetches.append(args)
+    try:
+      token = uvalibrary_api.encode_page_token(catalog.next_request(request_class(query='page token', per_page=10), 25))
+      self.assertIsNone( catalog.next_request(request_class(query='page token', per_page=10, page=3), 25) )
+      # per_page is at least 1, so the pages still run out
+      self.assertIsNone( catalog.next_request(request_class(query='page token', per_page=0, page=25), 25) )
+      next_request = uvalibrary_api.decode_page_token(request_class, token)
+      catalog.prefetch_async(next_request).get_result()
+      # the instance remembers the prefetch, so asking again makes no memcache call
+      memcache.delete('prefetch_'+uvalibrary_api.search_key('search', catalog.search_url(next_request)[0]))
+      catalog.prefetch_async(next_request).get_result()
+    finally:
+      uvalibrary_api.deferred.defer = defer
+    self.assertEqual( (next_request.query, next_request.page, next_request.per_page), ('page token', 2, 10) )
+    # the page prefetched is the one the token asks for
+    self.assertEqual( [args[1] for args in prefetches], [uvalibrary_api.search_key('search', catalog.search_url(next_request)[0])] )
+    with self.assertRaises(endpoints.BadRequestException):
+      uvalibrary_api.decode_page_token(request_class, 'not a token')
+
+  def testSearchAvailabilityFields(self):
+    calls = []
+    class Catalog(uvalibrary_api.CatalogApi):
+      @ndb.tasklet
+      def fetch_firehose_async(self, id, deadline):
+        calls.append(id)
+        raise ndb.Return('<catalogItem></catalogItem>')
+    @ndb.tasklet
+    def fetch_catalog(url, fields=None, facet_names=None, urlkey=None):
+      raise ndb.Return(uvalibrary_api.encode_collection(uvalibrary_api.ItemCollection(count=1, items=[uvalibrary_api.Item(id='u8', title=['Eight'])])))
+    loader = uvalibrary_api.fetch_catalog
+    uvalibrary_api.fetch_catalog = fetch_catalog
+    try:
+      request_class = uvalibrary_api.CatalogApi.SEARCH_RESOURCE.combined_message_class
+      # none of the firehose fields asked for, no firehose call
+      Catalog().search_async(request_class(query='availability fields', fields='title', availability=True)).get_result()
+      self.assertEqual( calls, [] )
+      Catalog().search_async(request_class(query='availability fields', fields='title,can_hold', availability=True)).get_result()
+      self.assertEqual( calls, ['u8'] )
+    finally:
+      uvalibrary_api.fetch_catalog = loader
+
+  def testDirectionStoreRefreshing(self):
+    store = uvalibrary_api.DirectionStore(60)
+    encoded = uvalibrary_api.encode_cached(uvalibrary_api.DirectionCollection())
+    memcache.set('item-directions', (time.time() + 60, encoded))
+    # a cold load leaves the flag of a refresh running on another thread alone
+    store.refreshing = True
+    store.current()
+    self.assertTrue( store.refreshing )
+    # the refresh that took the flag clears it
+    store.refreshing = False
+    store.checked = 0
+    store.current()
+    self.assertFalse( store.refreshing )
+    self.assertEqual( store.snapshot.version, hashlib.sha1(encoded).hexdigest() )
+
+  def testConcurrentLoads(self):
+    events = []
+    @ndb.tasklet
+    def fetch_catalog(url, fields=None, facet_names=None, urlkey=None):
+      events.append('catalog')
+      yield ndb.sleep(0.05)
+      events.append('catalog done')
+      raise ndb.Return(uvalibrary_api.encode_collection(uvalibrary_api.ItemCollection(count=1, items=[uvalibrary_api.Item(id='x1')])))
+    @ndb.tasklet
+    def directions():
+      events.append('directions')
+      yield ndb.sleep(0.05)
+      events.append('directions done')
+      raise ndb.Return(uvalibrary_api.DirectionSnapshot(None, 'v1', uvalibrary_api.DirectionMatcher(uvalibrary_api.DirectionCollection())))
+    loader = uvalibrary_api.fetch_catalog
+    uvalibrary_api.fetch_catalog = fetch_catalog
+    uvalibrary_api.directionStore.current_async = directions
+    try:
+      request_class = uvalibrary_api.CatalogApi.SEARCH_RESOURCE.combined_message_class
+      uvalibrary_api.CatalogApi().search_async(request_class(query='concurrent loads', availability=True, directions=True)).get_result()
+    finally:
+      uvalibrary_api.fetch_catalog = loader
+      del uvalibrary_api.directionStore.current_async
+    # the directions load runs alongside the catalog fetch
+    self.assertEqual( sorted(events[:2]), ['catalog', 'directions'] )
+
+    flight = [0, 0]
+    class Catalog(uvalibrary_api.CatalogApi):
+      @ndb.tasklet
+      def fetch_firehose_async(self, id, deadline):
+        flight[0] += 1
+        flight[1] = max(flight)
+        yield ndb.sleep(0.01)
+        flight[0] -= 1
+        raise ndb.Return('<catalogItem></catalogItem>')
+    concurrency, uvalibrary_api.availabilityConcurrency = uvalibrary_api.availabilityConcurrency, 4
+    try:
+      collection = uvalibrary_api.ItemCollection(items=[uvalibrary_api.Item(id='u%d' % (9000 + i)) for i in xrange(10)])
+      Catalog().get_collection_availability(collection, False)
+    finally:
+      uvalibrary_api.availabilityConcurrency = concurrency
+    # the workers keep availabilityConcurrency firehose calls in flight
+    self.assertEqual( flight[1], 4 )
+    self.assertFalse( any(item.availability_pending for item in collection.items) )
@@ -1,23 +1,104 @@
-import urllib, urllib2, json, hashlib, logging, time, re, itertools
-import xml.etree.ElementTree as ET
+import os, urllib, urllib2, json, hashlib, logging, time, datetime, re, bisect, heapq, collections, threading, base64, zlib, contextlib, functools
+try:
+  import xml.etree.cElementTree as ET
+except ImportError:
+  import xml.etree.ElementTree as ET
+from cStringIO import StringIO
 
 import endpoints
+import webapp2
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 from protorpc import protojson
+from protorpc import protobuf
 
 from google.appengine.api import memcache
 from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.api import urlfetch
 
 package = 'UVALibrary'
 
 api_version = 'v0.1'
 catalogURL = "http://search.lib.virginia.edu/catalog.json"
+catalogItemURL = "http://search.lib.virginia.edu/catalog/%s.json"
 directionsURL = "https://spreadsheets.google.com/feeds/list/1FTA9scrRR17pmeRZNPOXZAYhgeG-40FcJp6Ry5_O7Gw/1/public/full?alt=json"
 librariesURL = "http://www.library.virginia.edu/api/get_recent_posts/?count=0&post_type=uvalib_library"
+calendarURL = "https://www.googleapis.com/calendar/v3/calendars/%s/events?%s"
+# key of the Google Calendar API the hours are read with; there are no hours while it is empty
+calendarAPIKey = ""
 notAvailableLocations = ['CHECKEDOUT','INTERNET']
+# seconds an instance trusts its copy of the directions or libraries before checking memcache for a new version
+directionsTTL = 300
+librariesTTL = 300
+# in-process cache of built search results, in front of memcache
+searchCacheSize = 200
+searchCacheTTL = 60
+# memcache entries are served fresh until their soft expiry, served stale while one
+# deferred task refreshes them until their hard expiry, and dropped after that (seconds)
+catalogSoftTTL = 300
+catalogHardTTL = 3600
+librariesSoftTTL = 3600
+librariesHardTTL = 86400
+directionsSoftTTL = 3600
+directionsHardTTL = 86400
+hoursSoftTTL = 1800
+hoursHardTTL = 86400
+# seconds an instance trusts its copy of the hours table, and the days the table covers starting yesterday
+hoursTTL = 300
+hoursDays = 60
+# the libraries' hours are in US Eastern time: its calendar time zone, and its UTC offset outside daylight saving time
+hoursTimeZone = 'America/New_York'
+hoursUTCOffset = -5
+# staff directory export, the URL of its feed or a JSON file deployed with the app; the directory is empty while it is None
+directorySource = None
+directorySoftTTL = 3600
+directoryHardTTL = 86400
+# seconds an instance trusts its directory index, the most entries a page or a type-ahead answer holds,
+# and the prefixes this short whose matches are merged ahead of time
+directoryTTL = 300
+directoryMaxPerPage = 100
+directorySuggestLimit = 10
+directoryShortPrefix = 2
+# firehose calls made at once for one search, the seconds a single call may take,
+# and the seconds a search may spend on availability before returning what it has
+availabilityConcurrency = 10
+availabilityCallDeadline = 5
+availabilityBudget = 8
+# seconds parsed firehose holdings are reused, circulation status may be this old
+holdingsTTL = 60
+holdingsCacheSize = 500
+# items from searches are written to the items_ cache in batches of this many,
+# or once the oldest one has waited this many seconds
+itemCacheBatch = 50
+itemCacheMaxDelay = 5
+# the most items a search page holds
+searchMaxPerPage = 100
+# the most ids one get_items call takes, the ones not cached all go into a single catalog GET
+maxItemIds = 50
+# part of every search and facets cache key, bump it when what is cached for a query changes
+searchCacheVersion = 2
+# cached messages are protobuf behind a two byte header: the codec version, then z when zlib compressed or p when not.
+# values of another version, in memcache or in snapshots, are misses and are loaded again
+cacheCodecVersion = '1'
+# encodings at least this many bytes long are compressed
+cacheCompressMin = 1024
+# memcache values are at most memcache.MAX_VALUE_SIZE (10**6) bytes once pickled with their soft expiry,
+# values longer than this are split into chunks of this many bytes; the headroom is for the pickling
+cacheChunkSize = memcache.MAX_VALUE_SIZE - 1024
+# how long an instance holds the fetch lock for a key, and how long others wait on it
+fetchLockTTL = 30
+fetchLockWait = 10
+# searches a new instance runs during warmup so its search cache starts out with them, as search parameters
+warmupSearches = [
+  {'query': ''},
+  {'query': '', 'facets_mode': 'none', 'per_page': 20},
+]
+# raw upstream responses are only logged when this is on, they are large and logged on every search
+logResponseBodies = False
+# upper bounds (ms) of the latency histogram buckets, the last bucket takes everything slower
+latencyBucketsMs = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
 an_api = endpoints.api(name="uvalibrary", version=api_version)
 
 class Image(messages.Message):
@@ -63,6 +144,12 @@ class Holding(messages.Message):
   holdable = messages.BooleanField(10, default=False)
   remote = messages.BooleanField(11, default=False)
 
+class ItemAvailability(messages.Message):
+  """Holdings parsed from an item's firehose document, as cached."""
+  can_hold = messages.BooleanField(1)
+  can_hold_message = messages.StringField(2)
+  holdings = messages.MessageField(Holding, 3, repeated=True)
+
 class Facet(messages.Message):
   """Facet count from the catalog."""
   value = messages.StringField(1, required=True)
@@ -116,16 +203,20 @@ class Item(messages.Message):
   can_hold_message = messages.StringField(23)
   holdings = messages.MessageField(Holding, 24, repeated=True)
   cover_image_url = messages.StringField(25)
+  availability_pending = messages.BooleanField(26, default=False)
 
 class ItemCollection(messages.Message):
   """Collection of Items."""
   count = messages.IntegerField(1, default=0)
   items = messages.MessageField(Item, 2, repeated=True)
+  next_page_token = messages.StringField(3)
   facets = messages.MessageField(Facets, 25)
 
 class DirectionCollection(messages.Message):
   """Collection of Directions."""
   directions = messages.MessageField(Direction, 1, repeated=True)
+  etag = messages.StringField(2)
+  unchanged = messages.BooleanField(3, default=False)
 
 class Operator(messages.Enum):
   AND = 1
@@ -163,6 +254,586 @@ class Library(messages.Message):
 
 class LibraryCollection(messages.Message):
   libraries = messages.MessageField(Library, 1, repeated=True)
+  etag = messages.StringField(2)
+  unchanged = messages.BooleanField(3, default=False)
+
+class HoursInterval(messages.Message):
+  """Minutes after midnight a library opens and closes, closing after midnight is past 1440"""
+  opens = messages.IntegerField(1, required=True)
+  closes = messages.IntegerField(2, required=True)
+
+class DayHours(messages.Message):
+  date = messages.StringField(1, required=True)
+  label = messages.StringField(2)
+  intervals = messages.MessageField(HoursInterval, 3, repeated=True)
+
+class LibraryHours(messages.Message):
+  library = messages.StringField(1, required=True)
+  title = messages.StringField(2)
+  open_now = messages.BooleanField(3)
+  days = messages.MessageField(DayHours, 4, repeated=True)
+
+class HoursCollection(messages.Message):
+  libraries = messages.MessageField(LibraryHours, 1, repeated=True)
+
+class DirectoryEntry(messages.Message):
+  id = messages.StringField(1, required=True)
+  name = messages.StringField(2, required=True)
+  title = messages.StringField(3)
+  department = messages.StringField(4)
+  email = messages.StringField(5)
+  phone = messages.StringField(6)
+  office = messages.StringField(7)
+  library = messages.StringField(8)
+
+class DirectoryCollection(messages.Message):
+  count = messages.IntegerField(1, default=0)
+  entries = messages.MessageField(DirectoryEntry, 2, repeated=True)
+  page = messages.IntegerField(3)
+
+class CacheStats(messages.Message):
+  name = messages.StringField(1, required=True)
+  size = messages.IntegerField(2, default=0)
+  hits = messages.IntegerField(3, default=0)
+  misses = messages.IntegerField(4, default=0)
+  evictions = messages.IntegerField(5, default=0)
+  expirations = messages.IntegerField(6, default=0)
+  hit_ratio = messages.FloatField(7)
+
+class Counter(messages.Message):
+  name = messages.StringField(1, required=True)
+  value = messages.IntegerField(2, default=0)
+
+class ItemWriterStats(messages.Message):
+  queued = messages.IntegerField(1, default=0)
+  duplicates = messages.IntegerField(2, default=0)
+  written = messages.IntegerField(3, default=0)
+  batches = messages.IntegerField(4, default=0)
+  tasks_saved = messages.IntegerField(5, default=0)
+  pending = messages.IntegerField(6, default=0)
+
+class CacheStatsCollection(messages.Message):
+  caches = messages.MessageField(CacheStats, 1, repeated=True)
+  item_writer = messages.MessageField(ItemWriterStats, 2)
+  counters = messages.MessageField(Counter, 3, repeated=True)
+
+class LatencyStats(messages.Message):
+  name = messages.StringField(1, required=True)
+  count = messages.IntegerField(2, default=0)
+  mean_ms = messages.FloatField(3)
+  p50_ms = messages.FloatField(4)
+  p95_ms = messages.FloatField(5)
+  max_ms = messages.FloatField(6)
+  # samples at or under each of latencyBucketsMs, then the ones over the last bound
+  buckets = messages.IntegerField(7, repeated=True)
+
+class LatencyStatsCollection(messages.Message):
+  latencies = messages.MessageField(LatencyStats, 1, repeated=True)
+
+class LRUCache(object):
+  """ Bounded, thread-safe in-process cache whose entries expire after ttl seconds """
+  def __init__(self, name, size, ttl):
+    self.name = name
+    self.size = size
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+      expires, value = entry
+      if expires < time.time():
+        self.expirations += 1
+        self.misses += 1
+        return None
+      # most recently used entries live at the end
+      self.entries[key] = entry
+      self.hits += 1
+      return value
+
+  def peek(self, key):
+    """ Unexpired value for a key, without counting a hit or miss or making it recently used """
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] >= time.time():
+        return entry[1]
+
+  def set(self, key, value, ttl=None):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = (time.time() + (ttl or self.ttl), value)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def stats(self):
+    stats = CacheStats(name=self.name, size=len(self.entries), hits=self.hits, misses=self.misses,
+                       evictions=self.evictions, expirations=self.expirations)
+    if self.hits + self.misses:
+      stats.hit_ratio = float(self.hits) / (self.hits + self.misses)
+    return stats
+
+class LatencyRecorder(object):
+  """ Thread-safe latency samples, percentiles are taken over the most recent ones """
+  def __init__(self, name, samples=1000):
+    self.name = name
+    self.lock = threading.Lock()
+    self.recent = collections.deque(maxlen=samples)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.buckets = [0] * (len(latencyBucketsMs) + 1)
+
+  def record(self, seconds):
+    with self.lock:
+      self.recent.append(seconds)
+      self.count += 1
+      self.total += seconds
+      self.max = max(self.max, seconds)
+      self.buckets[bisect.bisect_left(latencyBucketsMs, seconds * 1000)] += 1
+
+  def stats(self):
+    with self.lock:
+      recent = sorted(self.recent)
+      stats = LatencyStats(name=self.name, count=self.count, buckets=list(self.buckets))
+      if recent:
+        stats.mean_ms = self.total * 1000 / self.count
+        stats.p50_ms = recent[len(recent) // 2] * 1000
+        stats.p95_ms = recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000
+        stats.max_ms = self.max * 1000
+      return stats
+
+class Metrics(object):
+  """ This instance's stage latencies and counters, plus a summary of the stages of the request being handled """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.recorders = collections.OrderedDict()
+    self.counters = collections.Counter()
+    # tasklets of a request all run on its thread
+    self.local = threading.local()
+
+  def recorder(self, name):
+    with self.lock:
+      if name not in self.recorders:
+        self.recorders[name] = LatencyRecorder(name)
+      return self.recorders[name]
+
+  def record(self, name, seconds):
+    self.recorder(name).record(seconds)
+    stages = getattr(self.local, 'stages', None)
+    if stages is not None:
+      stages[name] = stages.get(name, 0.0) + seconds
+
+  @contextlib.contextmanager
+  def timer(self, name):
+    started = time.time()
+    try:
+      yield
+    finally:
+      self.record(name, time.time() - started)
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] += n
+    counts = getattr(self.local, 'counts', None)
+    if counts is not None:
+      counts[name] += n
+
+  def request(self, name):
+    """ Decorator timing a service method, it logs one line summing up the stages of each call """
+    def decorator(method):
+      @functools.wraps(method)
+      def timed(*args, **kwargs):
+        self.local.stages = collections.OrderedDict()
+        self.local.counts = collections.Counter()
+        started = time.time()
+        try:
+          return method(*args, **kwargs)
+        finally:
+          total = time.time() - started
+          self.recorder(name).record(total)
+          logging.info('request_timing '+json.dumps({
+            'request': name,
+            'total_ms': round(total * 1000, 1),
+            'stages_ms': dict( (stage, round(seconds * 1000, 1)) for stage, seconds in self.local.stages.items() ),
+            'counts': dict(self.local.counts)
+          }, sort_keys=True))
+          self.local.stages = self.local.counts = None
+      return timed
+    return decorator
+
+  def latency_stats(self):
+    with self.lock:
+      recorders = list(self.recorders.values())
+    return [recorder.stats() for recorder in recorders]
+
+  def counter_stats(self):
+    with self.lock:
+      return [Counter(name=name, value=value) for name, value in sorted(self.counters.items())]
+
+metrics = Metrics()
+
+def frame(data):
+  """ Cache value for protobuf bytes """
+  if len(data) >= cacheCompressMin:
+    return cacheCodecVersion + 'z' + zlib.compress(data)
+  return cacheCodecVersion + 'p' + data
+
+def unframe(value):
+  """ The protobuf bytes in a cache value, None when it was written by another codec version """
+  if value[:1] != cacheCodecVersion:
+    return None
+  if value[1:2] == 'z':
+    return zlib.decompress(value[2:])
+  return value[2:]
+
+def codec_current(value):
+  """ Whether a cache value was written by this codec version, or is protojson from before the codec """
+  return value[:1] in (cacheCodecVersion, '{')
+
+def encode_cached(message):
+  return frame(protobuf.encode_message(message))
+
+def decode_cached(message_type, value):
+  """ Message in a cache value, None when it was written by another codec version """
+  if value[:1] == '{':
+    # protojson, from before the codec
+    return protojson.decode_message(message_type, value)
+  data = unframe(value)
+  if data is None:
+    return None
+  return protobuf.decode_message(message_type, data)
+
+def read_varint(data, position):
+  value = shift = 0
+  while True:
+    byte = ord(data[position])
+    position += 1
+    value |= (byte & 0x7f) << shift
+    shift += 7
+    if not byte & 0x80:
+      return value, position
+
+def message_fields(data, number):
+  """ Raw bytes of each length delimited field with the given number in a protobuf encoding, in order """
+  found = []
+  position = 0
+  while position < len(data):
+    tag, position = read_varint(data, position)
+    wire_type = tag & 7
+    if wire_type == 0:
+      position = read_varint(data, position)[1]
+    elif wire_type == 1:
+      position += 8
+    elif wire_type == 5:
+      position += 4
+    elif wire_type == 2:
+      length, position = read_varint(data, position)
+      if tag >> 3 == number:
+        found.append(data[position:position+length])
+      position += length
+    else:
+      raise ValueError('Unexpected wire type %d' % wire_type)
+  return found
+
+def encode_collection(collection):
+  """ Search cache entry for a collection """
+  return encode_cached(collection)
+
+def decode_collection(entry, collection=None):
+  """ The collection in a search cache entry and its items' item cache values, keyed by the ids in the entry;
+  a collection built for the same search is used instead of decoding the entry when it has the entry's items """
+  data = unframe(entry)
+  # each item's bytes are already in the collection's encoding, and hold the item's id
+  items = message_fields(data, ItemCollection.field_by_name('items').number)
+  id_number = Item.field_by_name('id').number
+  ids = [message_fields(encoded, id_number)[0].decode('utf-8') for encoded in items]
+  # another request may have put a collection for a newer entry in the instance cache
+  if collection is None or [item.id for item in collection.items] != ids:
+    collection = protobuf.decode_message(ItemCollection, data)
+  return collection, dict( (id, frame(encoded)) for id, encoded in zip(ids, items) )
+
+def copy_message(message):
+  """ Shallow copy of a message, so a cached message is not changed when the copy is filled in """
+  return type(message)(**dict( (field.name, message.get_assigned_value(field.name)) for field in message.all_fields()
+                               if message.get_assigned_value(field.name) is not None ))
+
+class ItemCacheWriter(object):
+  """ Write-behind for the items_ cache, batching the items of many searches into one set_multi """
+  def __init__(self, batch, max_delay):
+    self.batch = batch
+    self.max_delay = max_delay
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.oldest = None
+    self.queued = 0
+    self.duplicates = 0
+    self.written = 0
+    self.batches = 0
+    self.tasks_saved = 0
+
+  def add(self, encoded):
+    """ Queues the items of one search, already encoded and keyed by id """
+    with self.lock:
+      self.duplicates += len(set(encoded) & set(self.pending))
+      self.pending.update(encoded)
+      self.queued += len(encoded)
+      # each call used to be its own deferred task
+      self.tasks_saved += 1
+      if self.oldest is None:
+        self.oldest = time.time()
+
+  def get(self, id):
+    """ The encoded item waiting to be written for an id, None when there is none """
+    with self.lock:
+      return self.pending.get(id)
+
+  def flush_async(self):
+    """ Starts writing the pending items when there are enough of them or the oldest has waited long enough, returns the rpc to wait on """
+    with self.lock:
+      if not self.pending:
+        return None
+      if len(self.pending) < self.batch and time.time() - self.oldest < self.max_delay:
+        return None
+      batch, self.pending, self.oldest = self.pending, {}, None
+      self.written += len(batch)
+      self.batches += 1
+    return memcache.set_multi_async(batch, key_prefix="items_")
+
+  @contextlib.contextmanager
+  def flushing(self):
+    """ Writes the pending items that are due while the block runs """
+    write = self.flush_async()
+    try:
+      yield
+    finally:
+      if write is not None:
+        write.get_result()
+
+  def stats(self):
+    return ItemWriterStats(queued=self.queued, duplicates=self.duplicates, written=self.written,
+                           batches=self.batches, tasks_saved=self.tasks_saved, pending=len(self.pending))
+
+itemCacheWriter = ItemCacheWriter(itemCacheBatch, itemCacheMaxDelay)
+searchCache = LRUCache('search', searchCacheSize, searchCacheTTL)
+holdingsCache = LRUCache('holdings', holdingsCacheSize, holdingsTTL)
+# next pages this instance asked to have prefetched lately, so popular searches skip the memcache add
+prefetchedSearches = LRUCache('prefetched', searchCacheSize, catalogSoftTTL)
+
+CacheChunks = collections.namedtuple('CacheChunks', ['key', 'count'])
+
+@ndb.tasklet
+def store_chunks_async(key, value, ttl):
+  """ Stores a value too big for one memcache entry under keys of its own, returns the CacheChunks to store in its place """
+  chunks = CacheChunks(key+'_'+hashlib.sha1(value).hexdigest()[:16], (len(value) + cacheChunkSize - 1) // cacheChunkSize)
+  context = ndb.get_context()
+  yield [context.memcache_set('%s_%d' % (chunks.key, i), value[i*cacheChunkSize:(i+1)*cacheChunkSize], time=ttl)
+         for i in xrange(chunks.count)]
+  raise ndb.Return(chunks)
+
+@ndb.tasklet
+def load_chunks_async(chunks):
+  """ The value a CacheChunks points at, None when any of its chunks is gone """
+  context = ndb.get_context()
+  parts = yield [context.memcache_get('%s_%d' % (chunks.key, i)) for i in xrange(chunks.count)]
+  raise ndb.Return(None if None in parts else ''.join(parts))
+
+@ndb.tasklet
+def swr_store_async(key, value, soft_ttl, hard_ttl):
+  stored = value
+  if isinstance(value, str) and len(value) > cacheChunkSize:
+    stored = yield store_chunks_async(key, value, hard_ttl)
+  yield ndb.get_context().memcache_set(key, (time.time() + soft_ttl, stored), time=hard_ttl)
+  raise ndb.Return(value)
+
+@ndb.tasklet
+def swr_read_async(key):
+  """ (soft expiry, value) from memcache, None when it has no entry, lost a chunk of it or was written by another codec version """
+  with metrics.timer('cache_lookup'):
+    entry = yield ndb.get_context().memcache_get(key)
+    if entry is None:
+      raise ndb.Return(None)
+    # entries written before soft expiry existed count as stale
+    if not isinstance(entry, tuple):
+      entry = (0, entry)
+    soft_expiry, value = entry
+    if isinstance(value, CacheChunks):
+      value = yield load_chunks_async(value)
+      if value is None:
+        raise ndb.Return(None)
+    if not codec_current(value):
+      metrics.count('memcache.old_codec')
+      raise ndb.Return(None)
+  raise ndb.Return((soft_expiry, value))
+
+def swr_refresh(key, loader, args, soft_ttl, hard_ttl):
+  """ Deferred task reloading a stale entry, the caller holds the fetch lock for the key """
+  try:
+    swr_store_async(key, loader(*args).get_result(), soft_ttl, hard_ttl).get_result()
+  finally:
+    memcache.delete(key+'_lock')
+
+@ndb.tasklet
+def swr_get_async(key, loader, args, soft_ttl, hard_ttl):
+  """ Memcache read with stale-while-revalidate; only one instance at a time runs the loader(*args) tasklet for a key """
+  context = ndb.get_context()
+  entry = yield swr_read_async(key)
+  if entry is not None:
+    soft_expiry, value = entry
+    if soft_expiry < time.time() and (yield context.memcache_add(key+'_lock', 1, time=fetchLockTTL)):
+      logging.info('Serving stale '+key+' while it is refreshed')
+      metrics.count('memcache.stale')
+      deferred.defer(swr_refresh, key, loader, args, soft_ttl, hard_ttl)
+    else:
+      logging.info('Hit cache for '+key)
+      metrics.count('memcache.hit')
+    raise ndb.Return(value)
+  metrics.count('memcache.miss')
+
+  @ndb.tasklet
+  def load_locked():
+    try:
+      value = yield loader(*args)
+      raise ndb.Return((yield swr_store_async(key, value, soft_ttl, hard_ttl)))
+    finally:
+      yield context.memcache_delete(key+'_lock')
+
+  if (yield context.memcache_add(key+'_lock', 1, time=fetchLockTTL)):
+    raise ndb.Return((yield load_locked()))
+  # another instance is already fetching this key, wait for its result
+  deadline = time.time() + fetchLockWait
+  pause = 0.05
+  while time.time() < deadline:
+    yield ndb.sleep(pause)
+    pause = min(pause * 2, 0.5)
+    entry = yield swr_read_async(key)
+    if entry is not None:
+      raise ndb.Return(entry[1])
+    # the lock is gone without an entry when the holder's loader failed, one of the waiters takes over
+    if (yield context.memcache_add(key+'_lock', 1, time=fetchLockTTL)):
+      raise ndb.Return((yield load_locked()))
+  logging.warning('Gave up waiting on the fetch lock for '+key)
+  value = yield loader(*args)
+  raise ndb.Return((yield swr_store_async(key, value, soft_ttl, hard_ttl)))
+
+def swr_get(key, loader, args, soft_ttl, hard_ttl):
+  return swr_get_async(key, loader, args, soft_ttl, hard_ttl).get_result()
+
+class Snapshot(ndb.Model):
+  """ A version of an upstream source as fetched by the refresh job, keyed source@version """
+  source = ndb.StringProperty(required=True)
+  version = ndb.StringProperty(required=True)
+  value = ndb.BlobProperty(required=True, compressed=True)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+class SnapshotHead(ndb.Model):
+  """ The last known good version of a source, keyed by source """
+  version = ndb.StringProperty(required=True)
+  checked = ndb.DateTimeProperty(auto_now=True)
+  # validators the origin sent with that version, for conditional fetches
+  upstream_etag = ndb.StringProperty(indexed=False)
+  upstream_modified = ndb.StringProperty(indexed=False)
+
+@ndb.tasklet
+def refresh_snapshot_async(source, conditional=True):
+  """ Pulls a source from its origin, saving a new Snapshot when it changed, and warms memcache with it """
+  key, url, encode, soft_ttl, hard_ttl = snapshotSources[source]
+  head = yield SnapshotHead.get_by_id_async(source)
+  result = None
+  previous = None
+  if url is None:
+    value = yield encode()
+    if value is None:
+      logging.info('No origin of %s is configured, not taking a snapshot' % source)
+      raise ndb.Return(None)
+  else:
+    headers = {}
+    if head is not None and conditional:
+      if head.upstream_etag:
+        headers['If-None-Match'] = head.upstream_etag
+      if head.upstream_modified:
+        headers['If-Modified-Since'] = head.upstream_modified
+    with metrics.timer('upstream.'+source):
+      result = yield ndb.get_context().urlfetch(url, headers=headers, deadline=10)
+    # an error page would be saved as an empty snapshot and replace the last good one
+    if result.status_code not in (200, 304):
+      raise urlfetch.Error('The %s origin answered HTTP %d' % (source, result.status_code))
+    if result.status_code == 304:
+      snapshot = yield Snapshot.get_by_id_async(source+'@'+head.version)
+      if snapshot is None or not codec_current(snapshot.value):
+        raise ndb.Return((yield refresh_snapshot_async(source, conditional=False)))
+      logging.info('%s is unchanged at its origin' % source)
+      value = snapshot.value
+    else:
+      with metrics.timer('json_decode'):
+        content = json.loads(result.content)
+      value = encode(content)
+  if result is None or result.status_code != 304:
+    version = hashlib.sha1(value).hexdigest()
+    if head is None or head.version != version:
+      logging.info('New %s snapshot %s' % (source, version))
+      yield Snapshot(id=source+'@'+version, source=source, version=version, value=value).put_async()
+      previous = head and head.version
+      head = SnapshotHead(id=source, version=version)
+    if result is not None:
+      head.upstream_etag = result.headers.get('ETag')
+      head.upstream_modified = result.headers.get('Last-Modified')
+  # also records when the origin was last checked
+  yield head.put_async()
+  # only the last good version is kept, the one the head pointed at is deleted once the head has moved
+  if previous:
+    yield ndb.Key(Snapshot, source+'@'+previous).delete_async()
+  yield swr_store_async(key, value, soft_ttl, hard_ttl)
+  raise ndb.Return(value)
+
+@ndb.tasklet
+def load_snapshot(source):
+  """ The last known good value of a source; the origin is only fetched when there is no snapshot this codec version can read """
+  head = yield SnapshotHead.get_by_id_async(source)
+  if head is not None:
+    snapshot = yield Snapshot.get_by_id_async(source+'@'+head.version)
+    if snapshot is not None and codec_current(snapshot.value):
+      raise ndb.Return(snapshot.value)
+    if snapshot is not None:
+      logging.warning('The '+source+' snapshot was written by another codec version, taking a new one')
+      raise ndb.Return((yield refresh_snapshot_async(source, conditional=False)))
+  logging.warning('No snapshot of '+source+' yet, taking the first one')
+  raise ndb.Return((yield refresh_snapshot_async(source)))
+
+# this instance's index of each snapshot source, by source
+snapshotIndexes = {}
+
+def current_index(source, message_type, index_class, ttl):
+  """ This instance's index of a snapshot source, checked against memcache every ttl seconds and rebuilt when the snapshot changed """
+  index = snapshotIndexes.get(source)
+  if index is not None and time.time() - index.checked < ttl:
+    return index
+  key, url, encode, soft_ttl, hard_ttl = snapshotSources[source]
+  value = swr_get(key, load_snapshot, (source,), soft_ttl, hard_ttl)
+  version = hashlib.sha1(value).hexdigest()
+  if index is None or index.version != version:
+    with metrics.timer('serialization'):
+      collection = decode_cached(message_type, value)
+    with metrics.timer(source+'_index'):
+      index = index_class(collection, version)
+  index.checked = time.time()
+  snapshotIndexes[source] = index
+  return index
+
+def client_etag(service, etag=None):
+  """ The ETag a client already holds, from an etag parameter or its If-None-Match header """
+  if not etag:
+    headers = getattr(getattr(service, 'request_state', None), 'headers', None)
+    etag = headers and headers.get('If-None-Match')
+  return etag and etag.strip('"')
 
 STORED_GREETINGS = ItemCollection(items=[
     Item(id='hello world!'),
@@ -192,23 +863,193 @@ class LibraryApi(remote.Service):
                                     ) for lib in results['posts']]
     return collection
 
-  @endpoints.method(message_types.VoidMessage, LibraryCollection,
+  LIST_RESOURCE = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    etag=messages.StringField(1),
+    type=messages.EnumField(LibraryType, 2),
+    fields=messages.StringField(3)
+  )
+  @endpoints.method(LIST_RESOURCE, LibraryCollection,
                     path='list', 
                     http_method='GET',
                     name='list'
   )
-  def list(self, unused_request):
-    """ Listing of all the libraries with info """
-    libraries = memcache.get('libraries')
-    if libraries is None:
-        results = json.loads( urlfetch.fetch(url=librariesURL, deadline=10).content )
-        libraries = self.load_libraries( results )
-        memcache.set('libraries', protojson.encode_message(libraries))
-        return libraries
-    else:
-        logging.info('Hit cache for libraries list request!')
-        libraries = protojson.decode_message(LibraryCollection, libraries)
-        return libraries
+  @metrics.request('libraries.list')
+  def list(self, request):
+    """ Listing of the libraries, of one type and with only some fields when asked, or just unchanged=true when the client's etag is current """
+    index = current_libraries()
+    if client_etag(self, request.etag) == index.version:
+      return LibraryCollection(etag=index.version, unchanged=True)
+    return index.view(request.type, parse_fields(request.fields, libraryFields))
+
+  ID_RESOURCE = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    id=messages.StringField(1, required=True),
+    fields=messages.StringField(2)
+  )
+  @endpoints.method(ID_RESOURCE, Library,
+                    path='get/{id}',
+                    http_method='GET',
+                    name='get'
+  )
+  @metrics.request('libraries.get')
+  def get(self, request):
+    """ One library by its id (slug) """
+    library = current_libraries().get(request.id, parse_fields(request.fields, libraryFields))
+    if library is None:
+      raise endpoints.NotFoundException('No library %s' % request.id)
+    return library
+
+# the fields= names a libraries request may ask for, id and title are always returned
+libraryFields = set(field.name for field in Library.all_fields())
+
+class LibraryIndex(object):
+  """ The libraries of one snapshot by id and by type, with the filtered listings built from them so far """
+  def __init__(self, collection, version):
+    self.version = version
+    self.checked = time.time()
+    self.libraries = collection.libraries
+    self.by_id = dict( (library.id, library) for library in self.libraries )
+    self.by_type = collections.defaultdict(list)
+    for library in self.libraries:
+      self.by_type[library.type].append(library)
+    self.views = {}
+
+  def project(self, library, fields):
+    if fields is None:
+      return library
+    return Library(id=library.id, title=library.title, **dict( (name, library.get_assigned_value(name)) for name in fields
+                                                              if name not in ('id', 'title') and library.get_assigned_value(name) is not None ))
+
+  def get(self, id, fields=None):
+    library = self.by_id.get(id)
+    return library and self.project(library, fields)
+
+  def view(self, type=None, fields=None):
+    """ Listing of the libraries of a type, or all of them, with only the given fields """
+    key = (type, None if fields is None else tuple(sorted(fields)))
+    view = self.views.get(key)
+    if view is None:
+      libraries = type is None and self.libraries or self.by_type.get(type, [])
+      view = self.views[key] = LibraryCollection(etag=self.version, libraries=[self.project(library, fields) for library in libraries])
+    return view
+
+def current_libraries():
+  """ This instance's LibraryIndex """
+  return current_index('libraries', LibraryCollection, LibraryIndex, librariesTTL)
+
+def encode_libraries(results):
+  collection = LibraryApi().load_libraries(results)
+  if not collection.libraries:
+    raise ValueError('No libraries in the response')
+  return encode_cached(collection)
+
+# Item fields loaded straight from the Solr field of the same document
+itemSolrFields = [
+  ('title', 'title_display'),
+  ('subtitle', 'subtitle_display'),
+  ('format', 'format_facet'),
+  ('library', 'library_facet'),
+  ('barcode', 'barcode_facet'),
+  ('oclc', 'oclc_display'),
+  ('author', 'author_display'),
+  ('isbn', 'isbn_display'),
+  ('published_date', 'published_date_display'),
+  ('supplemental_url', 'url_supp_display'),
+  ('call_number', 'call_number_display'),
+  ('publisher', 'published_display'),
+  ('location', 'location2_facet'),
+  ('source', 'source_facet'),
+  ('date_indexed', 'date_first_indexed_facet'),
+  ('url', 'url_display'),
+  ('series_title', 'series_title_facet'),
+  ('medium', 'medium_display'),
+  ('upc', 'upc_display'),
+]
+# Facets fields and the Solr facet fields they count
+facetSolrFields = [
+  ('library', 'library_facet'),
+  ('location', 'location_facet'),
+  ('library_location', 'location2_facet'),
+  ('published_date', 'published_date_facet'),
+  ('format', 'format_facet'),
+  ('call_number', 'call_number_facet'),
+  ('digital_collection', 'digital_collection_facet'),
+  ('subject', 'subject_facet'),
+  ('language', 'language_facet'),
+  ('source', 'source_facet'),
+  ('series', 'series_title_facet'),
+  ('recordings_scores', 'recordings_and_scores_facet'),
+  ('recording_format', 'recording_format_facet'),
+  ('instrument', 'instrument_facet'),
+  ('music_composition_era', 'music_composition_era_facet'),
+  ('author', 'author_facet'),
+  ('region', 'region_facet'),
+  ('video_genre', 'video_genre_facet'),
+]
+# the fields= names a search may ask for: id is always returned, facets switches facet counts
+searchFields = set([name for name, solr_field in itemSolrFields] +
+                   ['score', 'cover_image_url', 'can_hold', 'can_hold_message', 'holdings', 'facets'])
+# the fields that come from the firehose, a search with availability asking for none of them makes no firehose calls
+availabilityFields = set(['holdings', 'can_hold', 'can_hold_message'])
+
+def parse_fields(fields, known=searchFields):
+  """ The set of field names in a comma separated fields= value, None when all fields are wanted """
+  names = set(name.strip() for name in (fields or '').split(',') if name.strip())
+  if not names:
+    return None
+  unknown = names - known
+  if unknown:
+    raise endpoints.BadRequestException('Unknown fields: '+', '.join(sorted(unknown)))
+  return names
+
+def parse_facets_mode(mode):
+  """ Facet names for a facets_mode value: None for all, an empty list for none, or the listed names """
+  if not mode or mode == 'all':
+    return None
+  if mode == 'none':
+    return []
+  names = set(name.strip() for name in mode.split(',') if name.strip())
+  unknown = names - set(name for name, solr_field in facetSolrFields)
+  if unknown:
+    raise endpoints.BadRequestException('Unknown facets: '+', '.join(sorted(unknown)))
+  return sorted(names)
+
+def normalize_text(text):
+  """ Search text with its whitespace collapsed, the catalog tokenizes on whitespace anyway """
+  return ' '.join((text or '').split()).encode('utf-8')
+
+def parse_facet_filters(facets):
+  """ Sorted (facet, sorted values) pairs from a facets JSON object whose values are one value or a list of them """
+  if not facets:
+    return []
+  try:
+    facets = json.loads(facets)
+  except ValueError:
+    raise endpoints.BadRequestException('Invalid facets JSON')
+  if not isinstance(facets, dict):
+    raise endpoints.BadRequestException('Invalid facets JSON')
+  filters = collections.defaultdict(set)
+  for facet, values in facets.items():
+    if not isinstance(values, list):
+      values = [values]
+    # facet names are lower case Solr fields, their values are matched exactly
+    filters[facet.strip().lower().encode('utf-8')].update(unicode(value).encode('utf-8') for value in values)
+  return sorted( (facet, sorted(values)) for facet, values in filters.items() if values )
+
+def search_key(prefix, url, fields=None):
+  """ Cache key of a catalog URL, with the sorted fields items are built with since score and cover_image_url never reach the URL """
+  if fields is not None:
+    url += '#' + ','.join(fields)
+  return '%s_%d_%s' % (prefix, searchCacheVersion, hashlib.sha1(url).hexdigest())
+
+def facet_params(names):
+  """ Solr parameters limiting facet counting to the named facets """
+  if names is None:
+    return []
+  if not names:
+    return [('facet', 'false')]
+  return [('facet.field', solr_field) for name, solr_field in facetSolrFields if name in names]
 
 @an_api.api_class(
   resource_name='catalog',
@@ -216,155 +1057,254 @@ class LibraryApi(remote.Service):
 )
 class CatalogApi(remote.Service):
 
-  def load_result(self, result):
-    return Item(
-      id=result['id'], 
-      title=result.get('title_display',[]),
-      subtitle=result.get('subtitle_display',[]),
-      format=result.get('format_facet',[]),
-      library=result.get('library_facet',[]),
-      barcode=result.get('barcode_facet',[]),
-      oclc=result.get('oclc_display',[]),
-      author=result.get('author_display',[]),
-      isbn=result.get('isbn_display',[]),
-      published_date=result.get('published_date_display',[]),
-      supplemental_url=result.get('url_supp_display',[]),
-      call_number=result.get('call_number_display',[]),
-      publisher=result.get('published_display',[]),
-      location=result.get('location2_facet',[]),
-      source=result.get('source_facet',[]),
-      date_indexed=result.get('date_first_indexed_facet',[]),
-      url=result.get('url_display',[]),
-      series_title=result.get('series_title_facet',[]),
-      medium=result.get('medium_display',[]),
-      upc=result.get('upc_display',[]),
-      score=result.get('score',0.0),
-      cover_image_url="http://search.lib.virginia.edu/catalog/"+result['id']+"/image.jpg"
-    )
-
-  def load_holdings(self, holdings_result, item, load_directions):
-    root = ET.fromstring(holdings_result.content)
-    can_hold = root.find('canHold')
-    if can_hold:
-      item.can_hold = can_hold.attrib.get('value',"yes") != "no"
-      item.can_hold_message = can_hold.find('message').text
-    holdings = root.findall('holding')
-    directions = Directions()
-    if len(holdings) > 0:
+  def load_result(self, result, fields=None):
+    """ Item from a Solr document, with only the requested fields when fields is given """
+    item = Item(id=result['id'])
+    for name, solr_field in itemSolrFields:
+      if fields is None or name in fields:
+        setattr(item, name, result.get(solr_field,[]))
+    if fields is None or 'score' in fields:
+      item.score = result.get('score',0.0)
+    if fields is None or 'cover_image_url' in fields:
+      item.cover_image_url = "http://search.lib.virginia.edu/catalog/"+result['id']+"/image.jpg"
+    return item
+
+  def load_holdings(self, content):
+    """ Parses a firehose document one holding at a time, clearing each one once it is loaded """
+    with metrics.timer('load_holdings'):
+      return self.parse_holdings(content)
+
+  def parse_holdings(self, content):
+    availability = ItemAvailability()
+    copies = []
+    depth = 0
+    for event, element in ET.iterparse(StringIO(content), events=('start', 'end')):
+      if event == 'start':
+        depth += 1
+        if depth == 1:
+          root = element
+        continue
+      depth -= 1
+      if depth == 2 and element.tag == 'copy':
+        copies.append(self.load_copy(element))
+      elif depth == 1 and element.tag == 'holding':
+        availability.holdings.append(self.load_holding(element, copies))
+        copies = []
+        root.clear()
+      elif depth == 1 and element.tag == 'canHold':
+        if element:
+          availability.can_hold = element.attrib.get('value',"yes") != "no"
+          availability.can_hold_message = element.find('message').text
+        root.clear()
+    return availability
+
+  def load_copy(self, copy_info):
+    copy = Copy()
+    copy.copy_number = copy_info.attrib.get('copyNumber','')
+    copy.current_periodical = copy_info.attrib.get('currentPeriodical','true') != "false"
+    copy.barcode = copy_info.attrib.get('barcode','')
+    copy.shadowed = copy_info.attrib.get('shadowed','true') != "false"
+    copy.circulate = copy_info.find('circulate') == "Y"
+    current_loc = copy_info.find('currentLocation')
+    copy.current_location = current_loc.find('name').text
+    copy.current_location_code = current_loc.attrib.get('code','')
+    home_loc = copy_info.find('homeLocation')
+    copy.home_location = home_loc.find('name').text
+    copy.home_location_code = home_loc.attrib.get('code','')
+    copy.item_type_code = copy_info.find('itemType').attrib.get('code','')
+    copy.last_checkout = copy_info.find('lastCheckout').text
+    copy_info.clear()
+    return copy
+
+  def load_holding(self, holding_info, copies):
+    holding = Holding()
+    holding.call_number = holding_info.attrib.get('callNumber','')
+    holding.call_number_normalized = holding_info.find('shelvingKey').text
+    holding.call_sequence = holding_info.attrib.get('callSequence','')
+    holding.can_hold = holding_info.attrib.get('holdable','true') != "false"
+    holding.shadowed = holding_info.attrib.get('shadowed','true') != "false"
+    holding.copies = copies
+    library_info = holding_info.find('library')
+    holding.library = library_info.find('name').text
+    holding.library_code = library_info.attrib.get('code','')
+    holding.deliverable = library_info.find('deliverable').text != "false"
+    holding.holdable = library_info.find('holdable').text != "false"
+    holding.remote = library_info.find('remote').text != "false"
+    return holding
+
+  def apply_availability(self, availability, item, directions=None, fields=None):
+    """ Puts (possibly cached and shared) holdings on an item, copying whatever gets a direction from the matcher; only the given fields when there are some """
+    if availability.can_hold is not None:
+      if fields is None or 'can_hold' in fields:
+        item.can_hold = availability.can_hold
+      if fields is None or 'can_hold_message' in fields:
+        item.can_hold_message = availability.can_hold_message
+    if fields is not None and 'holdings' not in fields:
+      return
+    if len(availability.holdings) > 0:
+      if directions is None:
+        item.holdings = availability.holdings
+        return
+      started = time.time()
       item.holdings = []
-      for holding_info in holdings:
-        holding = Holding()
-        holding.call_number = holding_info.attrib.get('callNumber','')
-        holding.call_number_normalized = holding_info.find('shelvingKey').text
-        holding.call_sequence = holding_info.attrib.get('callSequence','')
-        holding.can_hold = holding_info.attrib.get('holdable','true') != "false"
-        holding.shadowed = holding_info.attrib.get('shadowed','true') != "false"
+      for cached in availability.holdings:
+        holding = copy_message(cached)
         holding.copies = []
-        for copy_info in holding_info.findall('copy'):
-          copy = Copy()
-          copy.copy_number = copy_info.attrib.get('copyNumber','')
-          copy.current_periodical = copy_info.attrib.get('currentPeriodical','true') != "false"
-          copy.barcode = copy_info.attrib.get('barcode','')
-          copy.shadowed = copy_info.attrib.get('shadowed','true') != "false"
-          copy.circulate = copy_info.find('circulate') == "Y"
-          current_loc = copy_info.find('currentLocation')
-          library_info = holding_info.find('library')
-          holding.library = library_info.find('name').text
-          holding.library_code = library_info.attrib.get('code','')
-          copy.current_location = current_loc.find('name').text
-          copy.current_location_code = current_loc.attrib.get('code','')
-          if copy.current_location_code not in notAvailableLocations and load_directions:
-            copy.direction = directions.get_direction(holding.library_code, holding.call_number_normalized, item.format[0], copy.current_location)
-          home_loc = copy_info.find('homeLocation')
-          copy.home_location = home_loc.find('name').text
-          copy.home_location_code = home_loc.attrib.get('code','')
-          copy.item_type_code = copy_info.find('itemType').attrib.get('code','')
-          copy.last_checkout = copy_info.find('lastCheckout').text
+        for copy in cached.copies:
+          if copy.current_location_code not in notAvailableLocations:
+            copy = copy_message(copy)
+            copy.direction = directions.match(holding.library_code, holding.call_number_normalized, (item.format or [''])[0], copy.current_location)
           holding.copies.append(copy)
-        holding.deliverable = library_info.find('deliverable').text != "false"
-        holding.holdable = library_info.find('holdable').text != "false"
-        holding.remote = library_info.find('remote').text != "false"
         item.holdings.append(holding)
+      metrics.record('get_direction', time.time() - started)
 
   def load_facet(self, facet):
-    values = []
-    # facet values/counts come in a list/array, convert to dict
-    d = dict(itertools.izip_longest(*[iter(facet)] * 2, fillvalue=""))
-    for key in d:
-      f = Facet()
-      f.value = key
-      f.count = int(d[key])
-      values.append(f)
-    return values
-
-  def load_facets(self, facets):
+    # facet values/counts come in one flat list, kept in the order Solr ranked them
+    return [Facet(value=facet[i], count=int(facet[i+1])) for i in xrange(0, len(facet) - 1, 2)]
+
+  def load_facets(self, facets, names=None):
+    """ Facets from Solr's facet_fields, only the named ones when names is given """
     f_val = Facets()
-    f_val.library = self.load_facet( facets.get('library_facet',[]) )
-    f_val.location = self.load_facet( facets.get('location_facet',[]) )
-    f_val.library_location = self.load_facet( facets.get('location2_facet',[]) )
-    f_val.published_date = self.load_facet( facets.get('published_date_facet',[]) )
-    f_val.format = self.load_facet( facets.get('format_facet',[]) )
-    f_val.call_number = self.load_facet( facets.get('call_number_facet',[]) )
-    f_val.digital_collection = self.load_facet( facets.get('digital_collection_facet',[]) )
-    f_val.subject = self.load_facet( facets.get('subject_facet',[]) )
-    f_val.language = self.load_facet( facets.get('language_facet',[]) )
-    f_val.source = self.load_facet( facets.get('source_facet',[]) )
-    f_val.series = self.load_facet( facets.get('series_title_facet',[]) )
-    f_val.recordings_scores = self.load_facet( facets.get('recordings_and_scores_facet',[]) )
-    f_val.recording_format = self.load_facet( facets.get('recording_format_facet',[]) )
-    f_val.instrument = self.load_facet( facets.get('instrument_facet',[]) )
-    f_val.music_composition_era = self.load_facet( facets.get('music_composition_era_facet',[]) )
-    f_val.author = self.load_facet( facets.get('author_facet',[]) )
-    f_val.region = self.load_facet( facets.get('region_facet',[]) )
-    f_val.video_genre = self.load_facet( facets.get('video_genre_facet',[]) )
+    for name, solr_field in facetSolrFields:
+      if names is None or name in names:
+        setattr(f_val, name, self.load_facet( facets.get(solr_field,[]) ))
     return f_val
 
-  "do this ascyn so we don't have to wait"
   def get_collection_availability(self, collection, load_directions):
-    # For each item, get the availability
-    def handle_result(rpc, item):
-      result = rpc.get_result()
-      self.load_holdings(result, item, load_directions)
-
-    # Use a helper function to define the scope of the callback.
-    def create_callback(rpc, item):
-      return lambda: handle_result(rpc, item)
-
-    rpcs = []
-    for item in collection.items:
-      if re.match(r'u\d+$', item.id) is not None:
-        url = "http://search.lib.virginia.edu/catalog/"+item.id+"/firehose"
-        logging.info(url)
-        rpc = urlfetch.create_rpc(deadline=60)
-        rpc.callback = create_callback(rpc, item)
-        urlfetch.make_fetch_call(rpc, url)
-        rpcs.append(rpc)
-
-    # Finish all RPCs, and let callbacks process the results.
-    for rpc in rpcs:
-      rpc.wait()
-
-  def load_results(self, results):
+    self.load_availability_async(collection, load_directions).get_result()
+
+  @ndb.tasklet
+  def load_availability_async(self, collection, load_directions, directions=None, fields=None):
+    """ Loads holdings a few items at a time, items still waiting when the budget runs out are marked pending; only the given fields are applied when there are some """
+    context = ndb.get_context()
+    items = [item for item in collection.items if re.match(r'u\d+$', item.id) is not None]
+    found = {}
+    for item in items:
+      availability = holdingsCache.get(item.id)
+      if availability is not None:
+        found[item.id] = availability
+    # the memcache lookups are batched together with the directions load
+    lookups = [(id, context.memcache_get('holdings_'+id)) for id in set(item.id for item in items) - set(found)]
+    if load_directions and directions is None:
+      directions = directionStore.current_async()
+    matcher = None
+    if directions is not None:
+      matcher = (yield directions).matcher
+    with metrics.timer('cache_lookup'):
+      for id, lookup in lookups:
+        encoded = yield lookup
+        availability = encoded is not None and decode_cached(ItemAvailability, encoded) or None
+        if availability is not None:
+          found[id] = availability
+          holdingsCache.set(id, availability)
+    for item in items:
+      if item.id in found:
+        self.apply_availability(found[item.id], item, matcher, fields)
+    waiting = collections.deque(item for item in items if item.id not in found)
+    fetched = {}
+    budget_ends = time.time() + availabilityBudget
+
+    @ndb.tasklet
+    def fetch_holdings():
+      while waiting and budget_ends - time.time() > 0:
+        item = waiting.popleft()
+        started = time.time()
+        try:
+          try:
+            content = yield self.fetch_firehose_async(item.id, min(availabilityCallDeadline, budget_ends - time.time()))
+          finally:
+            metrics.record('upstream.firehose', time.time() - started)
+          availability = self.load_holdings(content)
+        except (urlfetch.Error, ET.ParseError) as e:
+          # an error page is not an item without holdings, so neither cache gets it
+          logging.warning('Availability for %s not loaded: %r' % (item.id, e))
+          metrics.count('upstream.firehose.errors')
+          item.availability_pending = True
+          continue
+        holdingsCache.set(item.id, availability)
+        fetched[item.id] = encode_cached(availability)
+        self.apply_availability(availability, item, matcher, fields)
+
+    # each of these keeps one firehose call in flight until the items or the budget run out
+    yield [fetch_holdings() for i in xrange(min(availabilityConcurrency, len(waiting)))]
+    # the autobatcher turns these into one set_multi
+    yield [context.memcache_set('holdings_'+id, encoded, time=holdingsTTL) for id, encoded in fetched.items()]
+    for item in waiting:
+      item.availability_pending = True
+    if waiting:
+      logging.warning('Availability budget ran out with %d items left' % len(waiting))
+
+  @ndb.tasklet
+  def fetch_firehose_async(self, id, deadline):
+    """ An item's firehose document """
+    result = yield ndb.get_context().urlfetch("http://search.lib.virginia.edu/catalog/"+id+"/firehose", deadline=deadline)
+    if result.status_code != 200:
+      raise urlfetch.Error('The firehose answered HTTP %d' % result.status_code)
+    raise ndb.Return(result.content)
+
+  def load_results(self, results, fields=None, facet_names=None):
+    with metrics.timer('load_results'):
+      return self.build_collection(results, fields, facet_names)
+
+  def build_collection(self, results, fields=None, facet_names=None):
     collection = ItemCollection()
-    logging.info(results)
+    if logResponseBodies:
+      logging.info(results)
     collection.count = int(results['response']['numFound'])
     for item in results['response']['docs']:
-      collection.items.append( self.load_result(item) )
-    collection.facets = self.load_facets(results['facet_counts']['facet_fields'])
+      collection.items.append( self.load_result(item, fields) )
+    if facet_names is None or facet_names:
+      collection.facets = self.load_facets(results['facet_counts']['facet_fields'], facet_names)
     return collection
 
+  # handles cache_collection tasks deferred before items went through itemCacheWriter
   def cache_collection(self, collection):
     coll = protojson.decode_message(ItemCollection, collection)
-    key_vals = dict( (x.id, protojson.encode_message(x)) for x in coll.items )
+    key_vals = dict( (x.id, encode_cached(x)) for x in coll.items )
     memcache.set_multi(key_vals, key_prefix="items_")
 
   def get_cached_item(self, id):
-    item = memcache.get("items_"+str(id))
+    # items from this instance's searches may not be written yet
+    item = itemCacheWriter.get(id) or memcache.get("items_"+id)
     if item is not None:
-      return protojson.decode_message(Item, item)
+      return decode_cached(Item, item)
     else:
       return item
 
+  def get_cached_items(self, ids):
+    """ Items found in the item cache, keyed by id """
+    pending = dict( (id, itemCacheWriter.get(id)) for id in ids )
+    cached = memcache.get_multi([id for id in ids if pending[id] is None], key_prefix="items_")
+    cached.update( (id, item) for id, item in pending.items() if item is not None )
+    items = dict( (id, decode_cached(Item, item)) for id, item in cached.items() )
+    return dict( (id, item) for id, item in items.items() if item is not None )
+
+  def fetch_item(self, id):
+    """ Loads a single record from the catalog, None when the catalog does not have it """
+    with metrics.timer('upstream.catalog'):
+      # a / in the id would change the catalog path
+      result = urlfetch.fetch(url=catalogItemURL % urllib.quote(id.encode('utf-8'), safe=''), deadline=10)
+    if result.status_code == 404:
+      return None
+    with metrics.timer('json_decode'):
+      document = json.loads(result.content)['response']['document']
+    return self.load_result(document)
+
+  def fetch_items(self, ids):
+    """ Loads several items from the catalog with a single OR query on their ids """
+    # ids are quoted, they can hold characters Solr treats as syntax (uva-lib:123)
+    params = [
+        ('q', ' OR '.join('id:"%s"' % id.replace('\\', '\\\\').replace('"', '\\"') for id in ids).encode('utf-8')),
+        ('per_page', len(ids))
+    ]
+    url = catalogURL + '?' + urllib.urlencode(params)
+    logging.info('URL: '+url)
+    with metrics.timer('upstream.catalog'):
+      content = urlfetch.fetch(url=url, deadline=10).content
+    with metrics.timer('json_decode'):
+      results = json.loads(content)
+    return [self.load_result(doc) for doc in results['response']['docs']]
+
   SEARCH_RESOURCE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     query=messages.StringField(1, default=''),
@@ -384,92 +1324,498 @@ class CatalogApi(remote.Service):
     publisher=messages.StringField(15, default=''),
     year_published_start=messages.StringField(16, default=''),
     year_published_end=messages.StringField(17, default=''),
-    sort_order=messages.EnumField(SortOrder, 18, default='relevancy')
+    sort_order=messages.EnumField(SortOrder, 18, default='relevancy'),
+    fields=messages.StringField(19),
+    facets_mode=messages.StringField(20, default='all'),
+    page_token=messages.StringField(21)
   )
+
+  def page_size(self, request):
+    """ Items per page of a search, at least 1 and at most searchMaxPerPage """
+    return max(1, min(request.per_page, searchMaxPerPage))
+
+  def search_params(self, request):
+    """ Catalog query parameters for a search request, in a canonical form so equivalent searches share cache keys """
+    advanced = False
+    if request.title:
+      request.query=""
+      advanced = True
+    params = [
+        ('q',normalize_text(request.query)),
+        ('per_page',self.page_size(request)),
+        # the catalog shows page 1 for page 0
+        ('page',max(request.page, 1)),
+        ('sort_key',request.sort_order),
+        ('op',request.operator)
+    ]
+    # advanced params, empty ones are left out
+    for name, value in [
+        ('author',request.author),
+        ('title',request.title),
+        ('journal',request.journal_title),
+        ('subject',request.subject),
+        ('keyword',request.keywords),
+        ('call_number',request.call_number),
+        ('published',request.publisher),
+        ('publication_date_start',request.year_published_start),
+        ('publication_date_end',request.year_published_end)
+    ]:
+      if normalize_text(value):
+        params.append( (name, normalize_text(value)) )
+    if advanced:
+      params.append( ('search_field','advanced') )
+
+    for facet, values in parse_facet_filters(request.facets):
+      for value in values:
+        params.append( ('f['+facet+'_facet][]', value) )
+    for facet, values in parse_facet_filters(request.facets_inclusive):
+      for value in values:
+        params.append( ('f_inclusive['+facet+'_facet]['+value+']', 1) )
+    return params
+
   @endpoints.method(SEARCH_RESOURCE, ItemCollection,
                     path='search', 
                     http_method='GET',
                     name='search'
   )
+  @metrics.request('catalog.search')
   def search(self, request):
     """ Queries the Library's catalog and digital collections """
     try:
-      advanced = False
-      if request.title:
-        request.query=""
-        advanced = True
-      params = [
-          ('q',request.query),
-          ('per_page',request.per_page),
-          ('page',request.page),
-          ('sort_key',request.sort_order),
-          # advanced params
-          ('op',request.operator),
-          ('author',request.author),
-          ('title',request.title),
-          ('journal',request.journal_title),
-          ('subject',request.subject),
-          ('keyword',request.keywords),
-          ('call_number',request.call_number),
-          ('published',request.publisher),
-          ('publication_date_start',request.year_published_start),
-          ('publication_date_end',request.year_published_end),
-          ('sort_key',request.sort_order)
-      ]
-      if advanced:
-        params.append( ('search_field','advanced') )
-
-      if request.facets:
-        facets = json.loads(request.facets)
-        for facet in facets:
-          if isinstance(facets[facet], list):
-            for value in facets[facet]:
-              params.append( ('f['+facet+'_facet][]', str(value) ) )
-          else:
-            params.append( ('f['+facet+'_facet][]', str(facets[facet])) )
-      if request.facets_inclusive:
-        facets = json.loads(request.facets_inclusive)
-        for facet in facets:
-          if isinstance(facets[facet], list):
-            for value in facets[facet]:
-              params.append( ('f_inclusive['+facet+'_facet]['+str(value)+']', 1) )
-          else:
-            params.append( ('f_inclusive['+facet+'_facet]['+str(facets[facet])+']', 1) )
-
-      url = catalogURL + '?' + urllib.urlencode(params)
-      logging.info('URL: '+url)
-      urlkey = hashlib.sha1(url).hexdigest()
-      results = memcache.get(urlkey)
-      if results is None:
-        results = json.loads( urlfetch.fetch(url=url, deadline=10).content )
-        memcache.set(urlkey, results)
-      else:
-        logging.info('Hit cache for catalog search request!')
-      collection = self.load_results(results)
-      deferred.defer( self.cache_collection, protojson.encode_message(collection) )
-      if request.availability:
-        self.get_collection_availability(collection, request.directions)
-      return collection
+      return self.search_async(request).get_result()
+    except endpoints.BadRequestException:
+      raise
+    except:
+      raise endpoints.InternalServerErrorException('Something went wrong with this catalog request!')
+
+  @ndb.tasklet
+  def search_async(self, request):
+    if request.page_token:
+      request = decode_page_token(type(request), request.page_token)
+    url, fields, facet_names = self.search_url(request)
+    logging.info('URL: '+url)
+    urlkey = search_key('search', url, fields)
+    availability = request.availability and (fields is None or bool(availabilityFields.intersection(fields)))
+    # the directions load runs alongside the catalog fetch, directions only go on holdings
+    directions = None
+    if availability and request.directions and (fields is None or 'holdings' in fields):
+      directions = directionStore.current_async()
+    collection = searchCache.get(urlkey)
+    if collection is None:
+      entry = yield swr_get_async(urlkey, fetch_catalog, (url, fields, facet_names, urlkey), catalogSoftTTL, catalogHardTTL)
+      # when the catalog was fetched for this request the collection it built is already in the instance cache
+      built = searchCache.peek(urlkey)
+      with metrics.timer('serialization'):
+        collection, encoded_items = decode_collection(entry, built)
+        if built is None:
+          searchCache.set(urlkey, collection)
+      # partial items would hide the full ones from get_item
+      if fields is None:
+        itemCacheWriter.add(encoded_items)
+    else:
+      logging.info('Hit instance cache for catalog search request!')
+    # the item cache write runs while availability is loaded
+    write = itemCacheWriter.flush_async()
+    # the cached collection is shared, the token and holdings go on a copy
+    items = collection.items
+    if availability:
+      items = [copy_message(item) for item in items]
+    next_request = self.next_request(request, collection.count)
+    collection = ItemCollection(count=collection.count, facets=collection.facets, items=items,
+                                next_page_token=next_request and encode_page_token(next_request))
+    # the next page's prefetch runs alongside the availability load
+    loads = []
+    if next_request is not None:
+      loads.append(self.prefetch_async(next_request))
+    if availability:
+      loads.append(self.load_availability_async(collection, directions is not None, directions, fields))
+    if loads:
+      yield loads
+    if write is not None:
+      write.get_result()
+    raise ndb.Return(collection)
+
+  def search_url(self, request):
+    """ Catalog URL for a search request, with the item fields and facets it asks for """
+    fields = parse_fields(request.fields)
+    facet_names = parse_facets_mode(request.facets_mode)
+    params = self.search_params(request)
+    if fields is not None:
+      if 'facets' not in fields:
+        facet_names = []
+      fields = sorted(fields)
+      # ask Solr for just the stored fields that will be used
+      params.append( ('fl', ','.join(['id', 'score'] + [solr_field for name, solr_field in itemSolrFields if name in fields])) )
+    params.extend( facet_params(facet_names) )
+    return catalogURL + '?' + urllib.urlencode(params), fields, facet_names
+
+  def next_request(self, request, count):
+    """ The search request for the page after this one, None on the last page """
+    page = max(request.page, 1)
+    if page * self.page_size(request) >= count:
+      return None
+    next_request = copy_message(request)
+    next_request.page = page + 1
+    next_request.page_token = None
+    return next_request
+
+  @ndb.tasklet
+  def prefetch_async(self, request):
+    """ Starts loading a search into the search cache, unless this instance holds it or asked for it lately """
+    url, fields, facet_names = self.search_url(request)
+    urlkey = search_key('search', url, fields)
+    if searchCache.peek(urlkey) is not None or prefetchedSearches.peek(urlkey) is not None:
+      return
+    prefetchedSearches.set(urlkey, True)
+    # one instance defers the prefetch, the others find the marker
+    if (yield ndb.get_context().memcache_add('prefetch_'+urlkey, 1, time=catalogSoftTTL)):
+      deferred.defer(prefetch_search, urlkey, url, fields, facet_names)
+
+  @endpoints.method(SEARCH_RESOURCE, Facets,
+                    path='facets',
+                    http_method='GET',
+                    name='facets'
+  )
+  @metrics.request('catalog.facets')
+  def facets(self, request):
+    """ Facet counts for a catalog search, without its items """
+    try:
+      with itemCacheWriter.flushing():
+        facet_names = parse_facets_mode(request.facets_mode)
+        # one id is the fewest documents the catalog will return
+        params = [(name, value) for name, value in self.search_params(request) if name not in ('per_page', 'page')]
+        params.extend( [('per_page', 1), ('fl', 'id')] + facet_params(facet_names) )
+        url = catalogURL + '?' + urllib.urlencode(params)
+        logging.info('URL: '+url)
+        urlkey = search_key('facets', url)
+        facets = searchCache.get(urlkey)
+        if facets is None:
+          encoded = swr_get(urlkey, fetch_facets, (url, facet_names), catalogSoftTTL, catalogHardTTL)
+          facets = decode_cached(Facets, encoded)
+          searchCache.set(urlkey, facets)
+        return facets
+    except endpoints.BadRequestException:
+      raise
     except:
       raise endpoints.InternalServerErrorException('Something went wrong with this catalog request!')
 
+  @endpoints.method(message_types.VoidMessage, CacheStatsCollection,
+                    path='cache_stats',
+                    http_method='GET',
+                    name='cache_stats'
+  )
+  def cache_stats(self, unused_request):
+    """ Hit/miss/eviction counters of this instance's catalog caches, and its other counters """
+    return CacheStatsCollection(caches=[searchCache.stats(), holdingsCache.stats()],
+                                item_writer=itemCacheWriter.stats(),
+                                counters=metrics.counter_stats())
+
+  @endpoints.method(message_types.VoidMessage, LatencyStatsCollection,
+                    path='latency_stats',
+                    http_method='GET',
+                    name='latency_stats'
+  )
+  def latency_stats(self, unused_request):
+    """ Latency of this instance's requests, their stages and its upstream calls """
+    return LatencyStatsCollection(latencies=metrics.latency_stats())
+
   ID_RESOURCE = endpoints.ResourceContainer(
       message_types.VoidMessage,
-      id=messages.StringField(1))
+      id=messages.StringField(1),
+      availability=messages.BooleanField(2, default=False),
+      directions=messages.BooleanField(3, default=False))
   @endpoints.method(ID_RESOURCE, Item,
                     path='get_item/{id}', http_method='GET',
                     name='get_item')
+  @metrics.request('catalog.get_item')
   def get_item(self, request):
-    """ Gets an item from the catalog (currently only after item has been in a search result) """
+    """ Gets an item from the catalog, from the item cache when it has been in a search result """
     try:
-      item = self.get_cached_item(request.id)
-      if item is not None:
+      with itemCacheWriter.flushing():
+        item = self.get_cached_item(request.id)
+        if item is None:
+          item = self.fetch_item(request.id)
+          if item is None:
+            raise endpoints.NotFoundException('I could not find that Item, Sorry!')
+          memcache.set("items_"+request.id, encode_cached(item))
+        if request.availability:
+          self.get_collection_availability(ItemCollection(items=[item]), request.directions)
         return item
-      else:
-        raise endpoints.NotFoundException('I could not find that Item, Sorry!')
+    except endpoints.NotFoundException:
+      raise
     except:
       raise endpoints.InternalServerErrorException('Something went wrong with this catalog request!')
 
+  IDS_RESOURCE = endpoints.ResourceContainer(
+      message_types.VoidMessage,
+      ids=messages.StringField(1, repeated=True))
+  @endpoints.method(IDS_RESOURCE, ItemCollection,
+                    path='get_items', http_method='GET',
+                    name='get_items')
+  @metrics.request('catalog.get_items')
+  def get_items(self, request):
+    """ Gets several items from the catalog, in the order they were asked for """
+    ids = [id for id in request.ids if id]
+    unique = collections.OrderedDict.fromkeys(ids).keys()
+    if len(unique) > maxItemIds:
+      raise endpoints.BadRequestException('At most %d ids can be asked for at once' % maxItemIds)
+    try:
+      with itemCacheWriter.flushing():
+        items = self.get_cached_items(unique) if unique else {}
+        missing = [id for id in unique if id not in items]
+        if missing:
+          fetched = dict( (item.id, item) for item in self.fetch_items(missing) )
+          if fetched:
+            memcache.set_multi(dict( (id, encode_cached(item)) for id, item in fetched.items() ), key_prefix="items_")
+          items.update(fetched)
+        collection = ItemCollection(items=[items[id] for id in ids if id in items])
+        collection.count = len(collection.items)
+        return collection
+    except:
+      raise endpoints.InternalServerErrorException('Something went wrong with this catalog request!')
+
+def scan_directions(directions, library, norm_call_number="", format_key="", location_key=""):
+  """ Original row-by-row directions lookup, kept as the reference for DirectionMatcher """
+  norm_call_number = norm_call_number.upper()
+  format_key = format_key.upper()
+  location_key = location_key.upper()
+  for direction in directions.directions:
+    if direction.library.lower() == library.lower():
+      if direction.location_key and location_key and direction.location_key.lower() in location_key.lower():
+        return direction
+      if direction.format_key and format_key and direction.call_key and norm_call_number and direction.format_key.lower() in format_key.lower() and direction.call_key.lower() in norm_call_number.lower():
+        return direction
+      if norm_call_number and direction.start_call_number and direction.end_call_number and norm_call_number.lower() >= direction.start_call_number.lower() and norm_call_number.lower() <= direction.end_call_number.lower():
+        return direction
+  return None
+
+class SubstringAutomaton(object):
+  """ Aho-Corasick automaton finding which of a fixed set of keys occur in a string """
+  def __init__(self, keys):
+    # keys is a list of (key, value) pairs, values of all matching keys are reported
+    self.goto = [{}]
+    self.fail = [0]
+    self.out = [[]]
+    for key, value in keys:
+      node = 0
+      for char in key:
+        nxt = self.goto[node].get(char)
+        if nxt is None:
+          nxt = len(self.goto)
+          self.goto[node][char] = nxt
+          self.goto.append({})
+          self.fail.append(0)
+          self.out.append([])
+        node = nxt
+      self.out[node].append(value)
+    queue = list(self.goto[0].values())
+    for node in queue:
+      for char, nxt in self.goto[node].items():
+        queue.append(nxt)
+        state = self.fail[node]
+        while state and char not in self.goto[state]:
+          state = self.fail[state]
+        fail = self.goto[state].get(char, 0)
+        self.fail[nxt] = fail if fail != nxt else 0
+        self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+  def matches(self, text):
+    """ Returns the set of values whose keys are substrings of text """
+    found = set()
+    node = 0
+    for char in text:
+      while node and char not in self.goto[node]:
+        node = self.fail[node]
+      node = self.goto[node].get(char, 0)
+      if self.out[node]:
+        found.update(self.out[node])
+    return found
+
+class DirectionMatcher(object):
+  """ Directions sheet compiled into per-library indexes, gives the same first match as scan_directions """
+  def __init__(self, directions):
+    self.rows = list(directions.directions)
+    libraries = {}
+    for index, direction in enumerate(self.rows):
+      if direction.library is not None:
+        libraries.setdefault(direction.library.lower(), []).append(index)
+    self.libraries = dict((library, self.compile_library(indexes)) for library, indexes in libraries.items())
+
+  def compile_library(self, indexes):
+    locations = []
+    formats = []
+    calls = []
+    ranges = []
+    for index in indexes:
+      direction = self.rows[index]
+      if direction.location_key:
+        locations.append( (direction.location_key.lower(), index) )
+      if direction.format_key and direction.call_key:
+        formats.append( (direction.format_key.lower(), index) )
+        calls.append( (direction.call_key.lower(), index) )
+      if direction.start_call_number and direction.end_call_number:
+        start = direction.start_call_number.lower()
+        end = direction.end_call_number.lower()
+        if start <= end:
+          ranges.append( (start, end, index) )
+    # call number ranges are flattened onto their sorted boundaries: for every boundary and
+    # every gap between two boundaries keep the first row whose range covers it
+    bounds = sorted(set([r[0] for r in ranges] + [r[1] for r in ranges]))
+    at_bound = [None] * len(bounds)
+    in_gap = [None] * (len(bounds) + 1)
+    for start, end, index in ranges:
+      first = bisect.bisect_left(bounds, start)
+      last = bisect.bisect_left(bounds, end)
+      for i in xrange(first, last + 1):
+        if at_bound[i] is None or index < at_bound[i]:
+          at_bound[i] = index
+      for i in xrange(first + 1, last + 1):
+        if in_gap[i] is None or index < in_gap[i]:
+          in_gap[i] = index
+    return {
+      'locations': locations and SubstringAutomaton(locations),
+      'formats': formats and SubstringAutomaton(formats),
+      'calls': calls and SubstringAutomaton(calls),
+      'bounds': bounds,
+      'at_bound': at_bound,
+      'in_gap': in_gap,
+    }
+
+  def match(self, library, norm_call_number="", format_key="", location_key=""):
+    compiled = self.libraries.get(library.lower())
+    if compiled is None:
+      return None
+    # normalize the same way scan_directions does
+    norm_call_number = norm_call_number.upper().lower()
+    format_key = format_key.upper().lower()
+    location_key = location_key.upper().lower()
+    candidates = []
+    if location_key and compiled['locations']:
+      candidates.extend( compiled['locations'].matches(location_key) )
+    if format_key and norm_call_number and compiled['formats']:
+      candidates.extend( compiled['formats'].matches(format_key) & compiled['calls'].matches(norm_call_number) )
+    if norm_call_number and compiled['bounds']:
+      i = bisect.bisect_left(compiled['bounds'], norm_call_number)
+      if i < len(compiled['bounds']) and compiled['bounds'][i] == norm_call_number:
+        index = compiled['at_bound'][i]
+      else:
+        index = compiled['in_gap'][i] if i < len(compiled['bounds']) else None
+      if index is not None:
+        candidates.append(index)
+    if not candidates:
+      return None
+    return self.rows[min(candidates)]
+
+def load_directions(results):
+  directions = DirectionCollection()
+  for entry in results.get('feed',{'entry':[]})['entry']:
+    direct = Direction()
+    direct.library = 'alderman'
+    direct.title = entry['gsx$title']['$t']
+    direct.location_key = entry['gsx$lockey']['$t']
+    direct.format_key = entry['gsx$formatkey']['$t']
+    direct.call_key = entry['gsx$callkey']['$t']
+    direct.start_call_number = entry['gsx$start']['$t']
+    direct.end_call_number = entry['gsx$end']['$t']
+    direct.floor = entry['gsx$floor']['$t']
+    direct.area = entry['gsx$area']['$t']
+    direct.direction = entry['gsx$direct']['$t']
+    directions.directions.append(direct)
+  return directions
+
+def encode_directions(results):
+  directions = load_directions(results)
+  if not directions.directions:
+    raise ValueError('No directions in the response')
+  return encode_cached(directions)
+
+DirectionSnapshot = collections.namedtuple('DirectionSnapshot', ['directions', 'version', 'matcher'])
+
+class DirectionStore(object):
+  """ Process-wide copy of the directions sheet, decoded and compiled once per version """
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.snapshot = None
+    self.checked = 0
+    self.refreshing = False
+
+  def current(self):
+    return self.current_async().get_result()
+
+  @ndb.tasklet
+  def current_async(self):
+    """ The current DirectionSnapshot, re-checking memcache at most once per ttl """
+    # a cold store loads without taking the flag, so only the request that took it may clear it
+    refreshing = False
+    if self.snapshot is not None:
+      if time.time() - self.checked < self.ttl:
+        raise ndb.Return(self.snapshot)
+      refreshing = self.start_refresh()
+      if not refreshing:
+        raise ndb.Return(self.snapshot)
+    try:
+      encoded = yield swr_get_async('item-directions', load_snapshot, ('directions',), directionsSoftTTL, directionsHardTTL)
+      self.install(encoded)
+    finally:
+      if refreshing:
+        self.refreshing = False
+    raise ndb.Return(self.snapshot)
+
+  def start_refresh(self):
+    # only one request refreshes, the others keep using the snapshot they already have
+    with self.lock:
+      if self.refreshing:
+        return False
+      self.refreshing = True
+      return True
+
+  def install(self, encoded):
+    version = hashlib.sha1(encoded).hexdigest()
+    if self.snapshot is None or self.snapshot.version != version:
+      logging.info('Loading directions version '+version)
+      directions = decode_cached(DirectionCollection, encoded)
+      directions.etag = version
+      self.snapshot = DirectionSnapshot(directions, version, DirectionMatcher(directions))
+    self.checked = time.time()
+
+directionStore = DirectionStore(directionsTTL)
+
+@ndb.tasklet
+def fetch_catalog(url, fields=None, facet_names=None, urlkey=None):
+  """ Search cache entry for a catalog URL, the collection built for it also goes in the instance cache under urlkey """
+  with metrics.timer('upstream.catalog'):
+    result = yield ndb.get_context().urlfetch(url, deadline=10)
+  with metrics.timer('json_decode'):
+    results = json.loads(result.content)
+  collection = CatalogApi().load_results(results, fields, facet_names)
+  if urlkey is not None:
+    searchCache.set(urlkey, collection)
+  with metrics.timer('serialization'):
+    raise ndb.Return(encode_collection(collection))
+
+def prefetch_search(urlkey, url, fields, facet_names):
+  """ Deferred task loading the next page of a search into the search cache """
+  swr_get(urlkey, fetch_catalog, (url, fields, facet_names, urlkey), catalogSoftTTL, catalogHardTTL)
+
+def encode_page_token(request):
+  return base64.urlsafe_b64encode(zlib.compress(protojson.encode_message(request)))
+
+def decode_page_token(request_class, token):
+  """ The search request a next_page_token was made from """
+  try:
+    return protojson.decode_message(request_class, zlib.decompress(base64.urlsafe_b64decode(str(token))))
+  except (TypeError, ValueError, zlib.error, messages.Error):
+    raise endpoints.BadRequestException('Invalid page_token')
+
+@ndb.tasklet
+def fetch_facets(url, facet_names=None):
+  with metrics.timer('upstream.catalog'):
+    result = yield ndb.get_context().urlfetch(url, deadline=10)
+  with metrics.timer('json_decode'):
+    results = json.loads(result.content)
+  raise ndb.Return(encode_cached(CatalogApi().load_facets(results['facet_counts']['facet_fields'], facet_names)))
+
 @an_api.api_class(
   resource_name="directions",
   path="directions"
@@ -477,79 +1823,45 @@ class CatalogApi(remote.Service):
 class Directions(remote.Service):
 
   def get_direction(self, library, norm_call_number="", format_key="", location_key=""):
-    norm_call_number = norm_call_number.upper()
-    format_key = format_key.upper()
-    location_key = location_key.upper()
-    if not hasattr(self, 'directions'):
-      logging.info('getting directions!')
-      self.list(message_types.VoidMessage())
-    for direction in self.directions.directions:
-      if direction.library.lower() == library.lower():
-        if direction.location_key and location_key and direction.location_key.lower() in location_key.lower():
-          return direction
-        if direction.format_key and format_key and direction.call_key and norm_call_number and direction.format_key.lower() in format_key.lower() and direction.call_key.lower() in norm_call_number.lower():
-          return direction
-        if norm_call_number and direction.start_call_number and direction.end_call_number and norm_call_number.lower() >= direction.start_call_number.lower() and norm_call_number.lower() <= direction.end_call_number.lower():
-          return direction
-    return None
-  
-  def load_directions(self, results):
-    self.directions = DirectionCollection()
-    for entry in results.get('feed',{'entry':[]})['entry']:
-      direct = Direction()
-      direct.library = 'alderman'
-      direct.title = entry['gsx$title']['$t']
-      direct.location_key = entry['gsx$lockey']['$t']
-      direct.format_key = entry['gsx$formatkey']['$t']
-      direct.call_key = entry['gsx$callkey']['$t']
-      direct.start_call_number = entry['gsx$start']['$t']
-      direct.end_call_number = entry['gsx$end']['$t']
-      direct.floor = entry['gsx$floor']['$t']
-      direct.area = entry['gsx$area']['$t']
-      direct.direction = entry['gsx$direct']['$t']
-      self.directions.directions.append(direct)
-    return self.directions
-
-  @endpoints.method(message_types.VoidMessage, DirectionCollection,
+    matcher = directionStore.current().matcher
+    with metrics.timer('get_direction'):
+      return matcher.match(library, norm_call_number, format_key, location_key)
+
+  def current_directions(self, etag):
+    snapshot = directionStore.current()
+    if client_etag(self, etag) == snapshot.version:
+      return DirectionCollection(etag=snapshot.version, unchanged=True)
+    return snapshot.directions
+
+  ETAG_RESOURCE = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    etag=messages.StringField(1)
+  )
+  @endpoints.method(ETAG_RESOURCE, DirectionCollection,
                     path='list', 
                     http_method='GET',
                     name='list'
   )
-  def list(self, unused_request):
+  @metrics.request('directions.list')
+  def list(self, request):
     """ Listing of all the (documented) directions to physical items in the library """
-    directs = memcache.get('item-directions')
-    if directs is None:
-        results = json.loads( urlfetch.fetch(url=directionsURL, deadline=10).content )
-        directs = self.load_directions(results)
-        memcache.set('item-directions', protojson.encode_message(directs))
-        return directs
-    else:
-        logging.info('Hit cache for directions list request!')
-        self.directions = protojson.decode_message(DirectionCollection, directs)
-        return self.directions
+    return self.current_directions(request.etag)
 
   DIRECTIONS_RESOURCE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     id=messages.StringField(1),
-    library=messages.StringField(2)
+    library=messages.StringField(2),
+    etag=messages.StringField(3)
   )
   @endpoints.method(DIRECTIONS_RESOURCE, DirectionCollection,
                     path='get', 
                     http_method='GET',
                     name='get'
   )
-  def get(self, unused_request):
+  @metrics.request('directions.get')
+  def get(self, request):
     """ Listing of all the (documented) directions to physical items in the library """
-    directs = memcache.get('item-directions')
-    if directs is None:
-        results = json.loads( urlfetch.fetch(url=directionsURL, deadline=10).content )
-        directs = self.load_directions(results)
-        memcache.set('item-directions', protojson.encode_message(directs))
-        return directs
-    else:
-        logging.info('Hit cache for directions list request!')
-        self.directions = protojson.decode_message(DirectionCollection, directs)
-        return self.directions
+    return self.current_directions(request.etag)
 
 
 @an_api.api_class(
@@ -573,35 +1885,380 @@ class RepositoryAPI(remote.Service):
     except:
       raise endpoints.InternalServerErrorException('Something went wrong with this image request')
 
+tokenPattern = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+  """ Lower case words of a text, apostrophes dropped so O'Brien is obrien """
+  if isinstance(text, str):
+    text = text.decode('utf-8')
+  return tokenPattern.findall((text or u'').lower().replace(u"'", u'').replace(u'\u2019', u''))
+
+class PrefixIndex(object):
+  """ Sorted tokens of some texts with the positions of the texts holding each, a prefix is looked up by bisection """
+  def __init__(self, texts):
+    postings = collections.defaultdict(set)
+    for position, text in enumerate(texts):
+      for token in tokenize(text):
+        postings[token].add(position)
+    self.tokens = sorted(postings)
+    self.postings = [frozenset(postings[token]) for token in self.tokens]
+    # a short prefix covers many tokens, so its positions are merged once here instead of on every keystroke
+    short = collections.defaultdict(set)
+    for token, positions in zip(self.tokens, self.postings):
+      for length in xrange(1, min(len(token), directoryShortPrefix) + 1):
+        short[token[:length]].update(positions)
+    self.short = dict( (prefix, frozenset(positions)) for prefix, positions in short.iteritems() )
+
+  def prefix(self, prefix):
+    """ Positions of the texts with a token starting with prefix """
+    if len(prefix) <= directoryShortPrefix:
+      return self.short.get(prefix, frozenset())
+    start = bisect.bisect_left(self.tokens, prefix)
+    end = bisect.bisect_left(self.tokens, prefix + u'\uffff', start)
+    if end - start == 1:
+      return self.postings[start]
+    positions = set()
+    for posting in self.postings[start:end]:
+      positions.update(posting)
+    return positions
+
+  def match(self, words):
+    """ Positions of the texts with a token starting with each of the words """
+    matches = None
+    # the longest words match the fewest texts, so the intersection shrinks fastest starting with them
+    for word in sorted(words, key=len, reverse=True):
+      positions = self.prefix(word)
+      matches = positions if matches is None else matches & positions
+      if not matches:
+        break
+    return matches or frozenset()
+
+class DirectoryIndex(object):
+  """ The directory of one snapshot by id, with prefix indexes over the names and over the names, titles and departments """
+  def __init__(self, collection, version):
+    self.version = version
+    self.checked = time.time()
+    self.entries = collection.entries
+    self.by_id = dict( (entry.id, entry) for entry in self.entries )
+    self.names = PrefixIndex(entry.name for entry in self.entries)
+    self.everything = PrefixIndex(u' '.join((entry.name, entry.title or u'', entry.department or u'')) for entry in self.entries)
+
+  def search(self, query, limit=None):
+    """ Positions of the entries matching every word of the query, the ones matching on their name first, each in name order """
+    words = tokenize(query)
+    if not words:
+      return range(len(self.entries))[:limit]
+    matches = self.everything.match(words)
+    names = self.names.match(words)
+    if limit is None:
+      return sorted(names) + sorted(matches - names)
+    first = heapq.nsmallest(limit, names)
+    return first + heapq.nsmallest(limit - len(first), matches - names)
+
+  def page(self, query, page, per_page):
+    positions = self.search(query)
+    start = (page - 1) * per_page
+    return DirectoryCollection(count=len(positions), page=page, entries=[self.entries[position] for position in positions[start:start + per_page]])
+
+  def suggest(self, query, limit):
+    """ The first entries matching a partly typed query, with only what a type-ahead list shows """
+    positions = self.search(query, limit)
+    return DirectoryCollection(count=len(positions), entries=[
+      DirectoryEntry(id=entry.id, name=entry.name, title=entry.title, department=entry.department)
+      for entry in (self.entries[position] for position in positions) ])
+
+def current_directory():
+  """ This instance's DirectoryIndex, an empty one while no directorySource is configured """
+  if directorySource is None:
+    return DirectoryIndex(DirectoryCollection(), None)
+  return current_index('directory', DirectoryCollection, DirectoryIndex, directoryTTL)
+
+def load_directory(results):
+  """ DirectoryCollection of a directory export, in order of last name then first name """
+  entries = [DirectoryEntry(id=person['id'],
+                            name=person['name'],
+                            title=person.get('title') or None,
+                            department=person.get('department') or None,
+                            email=person.get('email') or None,
+                            phone=person.get('phone') or None,
+                            office=person.get('office') or None,
+                            library=person.get('library') or None
+                            ) for person in results['people']]
+  def surname_first(entry):
+    words = tokenize(entry.name)
+    return words[-1:] + words[:-1], entry.id
+  entries.sort(key=surname_first)
+  return DirectoryCollection(count=len(entries), entries=entries)
+
+@ndb.tasklet
+def build_directory():
+  """ The directory export, from its feed or from the file deployed with the app, encoded for the cache; None while no directorySource is configured """
+  if directorySource is None:
+    raise ndb.Return(None)
+  if directorySource.startswith('http'):
+    with metrics.timer('upstream.directory'):
+      result = yield ndb.get_context().urlfetch(directorySource, deadline=30)
+    if result.status_code != 200:
+      raise urlfetch.Error('Directory feed answered HTTP %d' % result.status_code)
+    content = result.content
+  else:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), directorySource)) as export:
+      content = export.read()
+  with metrics.timer('json_decode'):
+    results = json.loads(content)
+  raise ndb.Return(encode_cached(load_directory(results)))
+
 @an_api.api_class(
   resource_name='directory',
   path='directory'
 )
 class DirectoryAPI(remote.Service):
 
-  @endpoints.method(message_types.VoidMessage, ItemCollection,
+  LIST_RESOURCE = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1, default=''),
+    page=messages.IntegerField(2, default=1),
+    per_page=messages.IntegerField(3, default=20)
+  )
+  @endpoints.method(LIST_RESOURCE, DirectoryCollection,
                     path='list', 
                     http_method='GET',
                     name='list'
   )
-  def list(self, unused_request):
-    """ Lists the entries in the Library's directory """
-    return STORED_GREETINGS
+  @metrics.request('directory.list')
+  def list(self, request):
+    """ Lists the entries in the Library's directory whose name, title or department have words starting with each word of the query, a page at a time """
+    per_page = max(1, min(request.per_page, directoryMaxPerPage))
+    return current_directory().page(request.query, max(request.page, 1), per_page)
+
+  SUGGEST_RESOURCE = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1, default=''),
+    limit=messages.IntegerField(2, default=directorySuggestLimit)
+  )
+  @endpoints.method(SUGGEST_RESOURCE, DirectoryCollection,
+                    path='suggest',
+                    http_method='GET',
+                    name='suggest'
+  )
+  @metrics.request('directory.suggest')
+  def suggest(self, request):
+    """ Type-ahead: the first entries matching what has been typed so far, answered from this instance's index """
+    return current_directory().suggest(request.query, max(1, min(request.limit, directoryMaxPerPage)))
 
   ID_RESOURCE = endpoints.ResourceContainer(
       message_types.VoidMessage,
-      id=messages.StringField(1))
-  @endpoints.method(ID_RESOURCE, Item,
+      id=messages.StringField(1, required=True))
+  @endpoints.method(ID_RESOURCE, DirectoryEntry,
                     path='entry/{id}', 
                     http_method='GET',
                     name='get')
+  @metrics.request('directory.get')
   def get(self, request):
     """ Gets an entry from the directory """
-    try:
-      return STORED_GREETINGS.items[request.id]
-    except (IndexError, TypeError):
-      raise endpoints.NotFoundException('Greeting %s not found.' %
+    entry = current_directory().by_id.get(request.id)
+    if entry is None:
+      raise endpoints.NotFoundException('Directory entry %s not found.' %
                                         (request.id,))
+    return entry
+
+def local_time(utc):
+  """ Wall clock time where the libraries are, for a UTC time; daylight saving time is from 2am on the second Sunday in March to 2am on the first Sunday in November """
+  local = utc + datetime.timedelta(hours=hoursUTCOffset)
+  march = datetime.datetime(local.year, 3, 8, 2)
+  november = datetime.datetime(local.year, 11, 1, 1)
+  starts = march + datetime.timedelta(days=(6 - march.weekday()) % 7)
+  ends = november + datetime.timedelta(days=(6 - november.weekday()) % 7)
+  if starts <= local < ends:
+    local += datetime.timedelta(hours=1)
+  return local
+
+def parse_date(text):
+  """ Date of an ISO (2015-01-31) or iCalendar (20150131) date, or of the date part of a time """
+  if text[4:5] == '-':
+    return datetime.date(int(text[0:4]), int(text[5:7]), int(text[8:10]))
+  return datetime.date(int(text[0:4]), int(text[4:6]), int(text[6:8]))
+
+def parse_event_time(value):
+  """ (date, minute of the day) of a calendar event's start or end, the minute is None for all day events """
+  if 'dateTime' in value:
+    stamp = value['dateTime']
+    return parse_date(stamp), int(stamp[11:13]) * 60 + int(stamp[14:16])
+  return parse_date(value['date']), None
+
+def parse_rule_until(until):
+  """ Last date a recurrence rule's UNTIL allows, UTC times are moved to local time first """
+  if until.endswith('Z'):
+    return local_time(datetime.datetime.strptime(until, '%Y%m%dT%H%M%SZ')).date()
+  return parse_date(until)
+
+weekdayCodes = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+
+def expand_recurrence(recurrence, start, first_day, last_day):
+  """ Dates between first_day and last_day of an event starting on start with RRULE and EXDATE lines; DAILY and WEEKLY rules are supported """
+  rule = None
+  excluded = set()
+  for line in recurrence:
+    name, value = line.split(':', 1)
+    if name == 'RRULE':
+      rule = dict(part.split('=', 1) for part in value.split(';'))
+    elif name.split(';')[0] == 'EXDATE':
+      excluded.update(parse_date(date) for date in value.split(','))
+  if rule is None or rule.get('FREQ') not in ('DAILY', 'WEEKLY'):
+    logging.warning('Only the first date of recurrence %r is used' % recurrence)
+    return [start] if first_day <= start <= last_day else []
+  interval = int(rule.get('INTERVAL', 1))
+  count = int(rule.get('COUNT', 0))
+  until = 'UNTIL' in rule and parse_rule_until(rule['UNTIL']) or last_day
+  weekdays = set(weekdayCodes.index(day[-2:]) for day in rule.get('BYDAY', '').split(',') if day) or set([start.weekday()])
+  week_start = start - datetime.timedelta(days=start.weekday())
+  dates = []
+  seen = 0
+  day = start
+  while day <= min(until, last_day):
+    if rule['FREQ'] == 'DAILY':
+      matches = (day - start).days % interval == 0
+    else:
+      matches = day.weekday() in weekdays and ((day - week_start).days // 7) % interval == 0
+    if matches:
+      seen += 1
+      if count and seen > count:
+        break
+      if day >= first_day and day not in excluded:
+        dates.append(day)
+    day += datetime.timedelta(days=1)
+  return dates
+
+def expand_events(events, first_day, last_day):
+  """ {date: DayHours} of a calendar's events between two dates, recurring events are expanded and their moved or cancelled instances applied """
+  # instances of recurring events that were moved or cancelled, by the event and the date they replace
+  replaced = set( (event['recurringEventId'], parse_event_time(event['originalStartTime'])[0])
+                  for event in events if 'recurringEventId' in event and 'originalStartTime' in event )
+  days = {}
+  # days an all day "Closed" event overrides the regular hours of
+  closed = set()
+  for event in events:
+    if event.get('status') == 'cancelled' or 'start' not in event:
+      continue
+    start, opens = parse_event_time(event['start'])
+    end, closes = parse_event_time(event['end'])
+    # an all day event covers every day from its start to the day before its end, so one that started before first_day can still cover it
+    span = opens is None and max(1, (end - start).days) or 1
+    reach = first_day - datetime.timedelta(days=span - 1)
+    if 'recurrence' in event:
+      starts = [day for day in expand_recurrence(event['recurrence'], start, reach, last_day) if (event['id'], day) not in replaced]
+    else:
+      starts = [start] if reach <= start <= last_day else []
+    dates = [day + datetime.timedelta(days=offset) for day in starts for offset in range(span)]
+    dates = [day for day in dates if first_day <= day <= last_day]
+    summary = event.get('summary', '').strip()
+    for day in dates:
+      hours = days.setdefault(day, DayHours(date=day.isoformat()))
+      if summary:
+        hours.label = hours.label and hours.label+', '+summary or summary
+      if opens is not None:
+        hours.intervals.append(HoursInterval(opens=opens, closes=closes + 1440 * (end - start).days))
+      elif '24 hours' in summary.lower():
+        hours.intervals.append(HoursInterval(opens=0, closes=1440))
+      elif 'closed' in summary.lower():
+        closed.add(day)
+  for day, hours in days.items():
+    if day in closed:
+      hours.intervals = []
+    hours.intervals.sort(key=lambda interval: interval.opens)
+  return days
+
+@ndb.tasklet
+def fetch_calendar(calendar_id, first_day, last_day):
+  """ Events of a calendar that overlap the days, recurring ones unexpanded; None when the calendar could not be loaded """
+  params = [
+    ('key', calendarAPIKey),
+    ('timeMin', first_day.isoformat()+'T00:00:00Z'),
+    ('timeMax', (last_day + datetime.timedelta(days=2)).isoformat()+'T00:00:00Z'),
+    ('timeZone', hoursTimeZone),
+    ('showDeleted', 'true'),
+    ('maxResults', 2500)
+  ]
+  try:
+    with metrics.timer('upstream.calendar'):
+      result = yield ndb.get_context().urlfetch(calendarURL % (urllib.quote(calendar_id), urllib.urlencode(params)), deadline=10)
+    if result.status_code != 200:
+      raise urlfetch.Error('HTTP %d' % result.status_code)
+  except urlfetch.Error as e:
+    logging.warning('Calendar %s not loaded: %r' % (calendar_id, e))
+    raise ndb.Return(None)
+  with metrics.timer('json_decode'):
+    raise ndb.Return(json.loads(result.content).get('items', []))
+
+@ndb.tasklet
+def last_hours():
+  """ {library: LibraryHours} of the last good hours snapshot, empty when there is none this codec version can read """
+  head = yield SnapshotHead.get_by_id_async('hours')
+  snapshot = None
+  if head is not None:
+    snapshot = yield Snapshot.get_by_id_async('hours@'+head.version)
+  if snapshot is None or not codec_current(snapshot.value):
+    raise ndb.Return({})
+  raise ndb.Return(dict( (hours.library, hours) for hours in decode_cached(HoursCollection, snapshot.value).libraries ))
+
+@ndb.tasklet
+def build_hours():
+  """ The hours table of every library with a calendar, for hoursDays days from yesterday, encoded for the cache; None while no calendarAPIKey is configured """
+  if not calendarAPIKey:
+    raise ndb.Return(None)
+  libraries = [library for library in current_libraries().libraries if library.hours_calendar_id]
+  first_day = local_time(datetime.datetime.utcnow()).date() - datetime.timedelta(days=1)
+  last_day = first_day + datetime.timedelta(days=hoursDays - 1)
+  # every calendar is fetched at once
+  calendars = yield [fetch_calendar(library.hours_calendar_id, first_day, last_day) for library in libraries]
+  # an empty table would be saved as the new snapshot and replace the last good one
+  if all(events is None for events in calendars):
+    raise urlfetch.Error('No hours calendar could be loaded')
+  # a library whose calendar failed keeps the days of the last good snapshot that are still in the table
+  last = None in calendars and (yield last_hours()) or {}
+  collection = HoursCollection()
+  for library, events in zip(libraries, calendars):
+    if events is None:
+      if library.id in last:
+        logging.warning('Keeping the last good hours of %s' % library.id)
+        collection.libraries.append(LibraryHours(library=library.id, title=library.title,
+                                                 days=[day for day in last[library.id].days if day.date >= first_day.isoformat()]))
+      continue
+    days = expand_events(events, first_day, last_day)
+    collection.libraries.append(LibraryHours(library=library.id, title=library.title,
+                                             days=[days[day] for day in sorted(days)]))
+  raise ndb.Return(encode_cached(collection))
+
+class HoursTable(object):
+  """ The hours of one snapshot by library and date """
+  def __init__(self, collection, version):
+    self.version = version
+    self.checked = time.time()
+    self.libraries = collection.libraries
+    self.days = dict( (hours.library, dict( (day.date, day) for day in hours.days )) for hours in self.libraries )
+
+  def open_at(self, library, moment):
+    """ Whether a library is open at a local time, the day before counts for hours past midnight """
+    minute = moment.hour * 60 + moment.minute
+    days = self.days.get(library, {})
+    for date, minute in [(moment.date(), minute), (moment.date() - datetime.timedelta(days=1), minute + 1440)]:
+      hours = days.get(date.isoformat())
+      if hours is not None and any(interval.opens <= minute < interval.closes for interval in hours.intervals):
+        return True
+    return False
+
+  def hours(self, library, first_day, count, now):
+    """ LibraryHours of a library for count days from first_day """
+    days = self.days[library.library]
+    dates = [(first_day + datetime.timedelta(days=i)).isoformat() for i in xrange(count)]
+    return LibraryHours(library=library.library, title=library.title, open_now=self.open_at(library.library, now),
+                        days=[days[date] for date in dates if date in days])
+
+def current_hours():
+  """ This instance's HoursTable, an empty one while no calendarAPIKey is configured """
+  if not calendarAPIKey:
+    return HoursTable(HoursCollection(), None)
+  return current_index('hours', HoursCollection, HoursTable, hoursTTL)
 
 @an_api.api_class(
   resource_name='hours',
@@ -609,14 +2266,51 @@ class DirectoryAPI(remote.Service):
 )
 class HoursAPI(remote.Service):
 
-  @endpoints.method(message_types.VoidMessage, ItemCollection,
+  def lookup(self, request):
+    """ The table, the first day, the number of days and the current local time for an hours request """
+    now = local_time(datetime.datetime.utcnow())
+    try:
+      first_day = request.date and parse_date(request.date) or now.date()
+    except ValueError:
+      raise endpoints.BadRequestException('Invalid date: '+request.date)
+    return current_hours(), first_day, max(1, min(request.days, hoursDays)), now
+
+  HOURS_RESOURCE = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    date=messages.StringField(1),
+    days=messages.IntegerField(2, default=1),
+    open_now=messages.BooleanField(3, default=False),
+    library=messages.StringField(4)
+  )
+  @endpoints.method(HOURS_RESOURCE, HoursCollection,
                     path='list', 
                     http_method='GET',
                     name='list'
   )
-  def list(self, unused_request):
-    """ List the Library's hours of opperation """
-    return STORED_GREETINGS
+  @metrics.request('hours.list')
+  def list(self, request):
+    """ List the Library's hours of opperation, from date (default today) for days days, or only the libraries open now """
+    table, first_day, count, now = self.lookup(request)
+    collection = HoursCollection()
+    for library in table.libraries:
+      hours = table.hours(library, first_day, count, now)
+      if hours.open_now or not request.open_now:
+        collection.libraries.append(hours)
+    return collection
+
+  @endpoints.method(HOURS_RESOURCE, LibraryHours,
+                    path='get',
+                    http_method='GET',
+                    name='get'
+  )
+  @metrics.request('hours.get')
+  def get(self, request):
+    """ Hours of one library, from date (default today) for days days """
+    table, first_day, count, now = self.lookup(request)
+    for library in table.libraries:
+      if library.library == request.library:
+        return table.hours(library, first_day, count, now)
+    raise endpoints.NotFoundException('No hours for library %s' % request.library)
 
 @an_api.api_class(
   resource_name='jobs',
@@ -633,4 +2327,57 @@ class JobsAPI(remote.Service):
     """ List the Library's available positions """
     return STORED_GREETINGS
 
-APPLICATION = endpoints.api_server([an_api])
\ No newline at end of file
+# source: (memcache key, origin URL, encoder of the origin's JSON, soft ttl, hard ttl);
+# sources without a URL come from several origins, their encoder is a tasklet building the value
+snapshotSources = {
+  'libraries': ('libraries', librariesURL, encode_libraries, librariesSoftTTL, librariesHardTTL),
+  'directions': ('item-directions', directionsURL, encode_directions, directionsSoftTTL, directionsHardTTL),
+  'hours': ('hours', None, build_hours, hoursSoftTTL, hoursHardTTL),
+  'directory': ('directory', None, build_directory, directorySoftTTL, directoryHardTTL),
+}
+
+class RefreshSnapshots(webapp2.RequestHandler):
+  """ Cron job pulling every snapshot source from its origin """
+  def get(self):
+    # an instance that stopped getting catalog requests still writes its last items
+    with itemCacheWriter.flushing():
+      self.refresh()
+
+  def refresh(self):
+    refreshes = [(source, refresh_snapshot_async(source)) for source in sorted(snapshotSources)]
+    for source, refresh in refreshes:
+      try:
+        value = refresh.get_result()
+        if source == 'directions':
+          directionStore.install(value)
+      except Exception:
+        logging.exception('Refreshing the %s snapshot failed, keeping the last good one' % source)
+        self.response.set_status(500)
+
+class Warmup(webapp2.RequestHandler):
+  """ Loads the directions, the libraries, the hours, the directory and the warmupSearches into a new instance before it is sent requests """
+  def get(self):
+    started = time.time()
+    stages = [('directions', directionStore.current), ('libraries', current_libraries), ('hours', current_hours),
+              ('directory', current_directory), ('searches', self.warm_searches)]
+    for name, stage in stages:
+      try:
+        with metrics.timer('warmup.'+name):
+          stage()
+      except Exception:
+        # a cold cache is not a reason to keep the instance from serving
+        logging.exception('Warming up the %s failed' % name)
+    logging.info('Warmed up in %.1f ms' % ((time.time() - started) * 1000))
+
+  def warm_searches(self):
+    catalog = CatalogApi()
+    request_class = CatalogApi.SEARCH_RESOURCE.combined_message_class
+    searches = [catalog.search_async(request_class(**params)) for params in warmupSearches]
+    for search in searches:
+      search.get_result()
+
+APPLICATION = endpoints.api_server([an_api])
+TASKS = webapp2.WSGIApplication([
+  ('/tasks/refresh_snapshots', RefreshSnapshots),
+  ('/_ah/warmup', Warmup),
+])
\ No newline at end of file